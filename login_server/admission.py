@@ -0,0 +1,117 @@
+"""Admission control for login requests.
+
+Requests are admitted if both the token bucket of their source address and the
+global token bucket have a token left. Buckets refill at a constant rate, up to
+their burst size. A source's bucket is forgotten once it would be full again,
+so that only recently active sources use memory. While ``max_sources`` sources
+are active, requests from new sources are rejected, so that a flood from many
+addresses cannot bypass the per-source buckets.
+"""
+
+from __future__ import annotations
+
+import time
+
+# Parameters' default
+SOURCE_RATE = 10.0
+SOURCE_BURST = 30.0
+GLOBAL_RATE = 0.0
+GLOBAL_BURST = 1000.0
+MAX_SOURCES = 100000
+
+
+class AdmissionControl:
+    """Per-source and global token buckets.
+
+    A rate of zero disables the corresponding bucket.
+    """
+
+    def __init__(
+        self,
+        source_rate: float = SOURCE_RATE,
+        source_burst: float = SOURCE_BURST,
+        global_rate: float = GLOBAL_RATE,
+        global_burst: float = GLOBAL_BURST,
+        max_sources: int = MAX_SOURCES,
+    ) -> None:
+        """Initialize buckets, all full."""
+        self.source_rate = source_rate
+        self.source_burst = source_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.max_sources = max_sources
+
+        # Source address to [tokens, last refill time]
+        self._sources: dict[str, list[float]] = {}
+        self._global_tokens = global_burst
+        self._global_time = time.monotonic()
+        self._sweep_interval = (
+            max(1.0, source_burst / source_rate) if source_rate > 0 else 0.0
+        )
+        self._next_sweep = self._global_time + self._sweep_interval
+
+        self.nb_rejected = 0
+
+    def admit(self, source: str) -> bool:
+        """Consume a token for a request from the given source, if possible."""
+        now = time.monotonic()
+        if self.source_rate > 0 and not self._admit_source(source, now):
+            self.nb_rejected += 1
+            return False
+        if self.global_rate > 0 and not self._admit_global(now):
+            self.nb_rejected += 1
+            return False
+        return True
+
+    def _admit_source(self, source: str, now: float) -> bool:
+        """Consume a token from a source's bucket."""
+        if now >= self._next_sweep:
+            self._sweep(now)
+
+        bucket = self._sources.get(source)
+        if bucket is None:
+            if len(self._sources) >= self.max_sources:
+                # Table is full of active sources, wait for some to be forgotten
+                return False
+            self._sources[source] = [self.source_burst - 1, now]
+            return True
+
+        tokens = min(
+            self.source_burst, bucket[0] + (now - bucket[1]) * self.source_rate
+        )
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def _admit_global(self, now: float) -> bool:
+        """Consume a token from the global bucket."""
+        self._global_tokens = min(
+            self.global_burst,
+            self._global_tokens + (now - self._global_time) * self.global_rate,
+        )
+        self._global_time = now
+        if self._global_tokens < 1:
+            return False
+        self._global_tokens -= 1
+        return True
+
+    def _sweep(self, now: float) -> None:
+        """Forget sources with a full bucket."""
+        rate = self.source_rate
+        burst = self.source_burst
+        self._sources = {
+            source: bucket
+            for source, bucket in self._sources.items()
+            if bucket[0] + (now - bucket[1]) * rate < burst
+        }
+        self._next_sweep = now + self._sweep_interval
+
+    def get_stats(self) -> dict:
+        """Get admission statistics."""
+        return {
+            "tracked_sources": len(self._sources),
+            "rejected": self.nb_rejected,
+        }
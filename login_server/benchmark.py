@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+
+"""UDP load generator and benchmark for the login service.
+
+Runs the UDP login service in a child process, against a temporary database,
+then simulates clients sending a mix of anonymous, password and create account
+requests. Each client waits for the response to its request before sending the
+next one.
+
+With ``--dispatch``, measures instead the cost of dispatching datagrams through
+the login service's endpoint under each event loop implementation, with a
+client in the same event loop and no database.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+from . import logindb, metrics, udpservice
+from .stnpcodec import encode_str
+
+# Parameters' default
+CLIENTS = 64
+DURATION = 10.0
+MIX = "anonymous=1,password=8,create=1"
+SEED_USERS = 1000
+TIMEOUT = 1.0
+DB_BACKEND = "json"
+DISPATCH_DATAGRAMS = 100000
+
+# Number of datagrams sent at once by the dispatch benchmark
+DISPATCH_BATCH = 256
+
+LOGIN_TYPES = {
+    "anonymous": udpservice.STNP_LOGIN_ANONYMOUS,
+    "password": udpservice.STNP_LOGIN_PASSWORD,
+    "create": udpservice.STNP_LOGIN_CREATE_ACCOUNT,
+}
+
+#
+# Messages generation
+#
+
+
+def login_request(
+    login_type: int,
+    user: str = "",
+    password: bytes = bytes(16),
+) -> bytes:
+    """Build a 34 bytes STNP login request."""
+    return (
+        bytes((udpservice.STNP_LOGIN_MSG_TYPE, login_type))
+        + encode_str(user).ljust(16, b"\0")
+        + password
+    )
+
+
+def seed_user(index: int) -> tuple[str, bytes]:
+    """Get the credentials of a preexisting user."""
+    return (f"seed{index}", index.to_bytes(16, "little"))
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    """Parse a requests mix description, like "anonymous=1,password=8"."""
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name not in LOGIN_TYPES:
+            raise click.BadParameter(f'unknown login type "{name}"')
+        weights[name] = int(weight)
+    return weights
+
+
+#
+# Server side
+#
+
+
+def _server_process(
+    db_file: Path,
+    db_backend: str,
+    udp_workers: int,
+    nb_seed_users: int,
+    loop: str,
+    pipe: multiprocessing.connection.Connection,
+) -> None:
+    """Run the login service until asked to stop, then send back its metrics."""
+    logindb.load(db_file, backend=db_backend)
+    for user_index in range(nb_seed_users):
+        user, password = seed_user(user_index)
+        logindb.register_user(user, password.hex())
+    metrics.reset()
+
+    async def serve():
+        transport = await udpservice.serve(0, workers=udp_workers)
+        pipe.send(transport.get_extra_info("sockname")[1])
+        await asyncio.get_running_loop().run_in_executor(None, pipe.recv)
+        transport.close()
+        pipe.send(metrics.get_metrics())
+
+    event_loop = udpservice.new_event_loop(loop)
+    asyncio.set_event_loop(event_loop)
+    try:
+        event_loop.run_until_complete(serve())
+    finally:
+        event_loop.close()
+
+
+#
+# Client side
+#
+
+
+class BenchmarkClient(asyncio.DatagramProtocol):
+    """Simulated client, sending one request at a time."""
+
+    def __init__(self) -> None:
+        """Initialize the client."""
+        self.response: asyncio.Future | None = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        """Store the transport."""
+        self.transport = transport
+
+    def datagram_received(self, message: bytes, addr: tuple[str, int]) -> None:
+        """Resolve the pending request."""
+        if self.response is not None and not self.response.done():
+            self.response.set_result(message)
+
+    async def request(self, message: bytes, timeout: float) -> bytes | None:
+        """Send a request, return the response or None on timeout."""
+        self.response = asyncio.get_running_loop().create_future()
+        self.transport.sendto(message)
+        try:
+            return await asyncio.wait_for(self.response, timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+async def _run_client(
+    client_index: int,
+    port: int,
+    weights: dict[str, int],
+    nb_seed_users: int,
+    deadline: float,
+    timeout: float,
+    results: dict[str, list[float]],
+    timeouts: dict[str, int],
+) -> None:
+    """Send requests from one simulated client until the deadline."""
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(
+        BenchmarkClient, remote_addr=("127.0.0.1", port)
+    )
+    rand = random.Random(client_index)
+    kinds = list(weights)
+    kinds_weights = [weights[kind] for kind in kinds]
+    nb_created = 0
+    try:
+        while time.monotonic() < deadline:
+            kind = rand.choices(kinds, kinds_weights)[0]
+            if kind == "anonymous":
+                message = login_request(LOGIN_TYPES[kind])
+            elif kind == "password" and nb_seed_users > 0:
+                user, password = seed_user(rand.randrange(nb_seed_users))
+                message = login_request(LOGIN_TYPES[kind], user, password)
+            else:
+                kind = "create"
+                user = f"c{client_index}x{nb_created}"
+                nb_created += 1
+                password = rand.getrandbits(128).to_bytes(16, "little")
+                message = login_request(LOGIN_TYPES[kind], user, password)
+
+            begin = time.perf_counter()
+            response = await client.request(message, timeout)
+            if response is None:
+                timeouts[kind] += 1
+            else:
+                results[kind].append(time.perf_counter() - begin)
+    finally:
+        transport.close()
+
+
+async def _run_clients(
+    port: int,
+    nb_clients: int,
+    weights: dict[str, int],
+    nb_seed_users: int,
+    duration: float,
+    timeout: float,
+) -> tuple[dict[str, list[float]], dict[str, int], float]:
+    """Run all simulated clients, return latencies, timeouts and duration."""
+    results: dict[str, list[float]] = {kind: [] for kind in LOGIN_TYPES}
+    timeouts = dict.fromkeys(LOGIN_TYPES, 0)
+    begin = time.monotonic()
+    await asyncio.gather(
+        *(
+            _run_client(
+                client_index,
+                port,
+                weights,
+                nb_seed_users,
+                begin + duration,
+                timeout,
+                results,
+                timeouts,
+            )
+            for client_index in range(nb_clients)
+        )
+    )
+    return (results, timeouts, time.monotonic() - begin)
+
+
+def _percentile(sorted_samples: list[float], ratio: float) -> float:
+    """Get a percentile of sorted samples."""
+    return sorted_samples[int(ratio * (len(sorted_samples) - 1))]
+
+
+def _report(name: str, samples: list[float], nb_timeouts: int, duration: float):
+    """Print statistics of a kind of requests."""
+    if not samples:
+        click.echo(f"{name:>10}: no response ({nb_timeouts} timeouts)")
+        return
+    samples = sorted(samples)
+    click.echo(
+        f"{name:>10}: {len(samples) / duration:9.1f} req/s"
+        f"  p50 {_percentile(samples, 0.5) * 1e6:8.0f} us"
+        f"  p99 {_percentile(samples, 0.99) * 1e6:8.0f} us"
+        f"  p999 {_percentile(samples, 0.999) * 1e6:8.0f} us"
+        f"  ({len(samples)} responses, {nb_timeouts} timeouts)"
+    )
+
+
+#
+# Dispatch benchmark
+#
+
+
+class _DispatchClient(asyncio.DatagramProtocol):
+    """Client counting responses to batches of requests."""
+
+    def __init__(self) -> None:
+        """Initialize the client."""
+        self.nb_expected = 0
+        self.done: asyncio.Future | None = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        """Store the transport."""
+        self.transport = transport
+
+    def expect(self, nb_expected: int) -> asyncio.Future:
+        """Expect responses, get a future resolved once all are received."""
+        self.nb_expected = nb_expected
+        self.done = asyncio.get_running_loop().create_future()
+        return self.done
+
+    def datagram_received(self, message: bytes, addr: tuple[str, int]) -> None:
+        """Count a response."""
+        self.nb_expected -= 1
+        if self.nb_expected == 0 and self.done is not None:
+            self.done.set_result(None)
+
+
+class _InlineExecutor(concurrent.futures.Executor):
+    """Executor running tasks in the calling thread."""
+
+    def submit(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        """Run the task immediately."""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+def _dispatch_benchmark(
+    loop: str,
+    nb_datagrams: int,
+    udp_workers: int,
+    executor: concurrent.futures.Executor | None,
+) -> tuple[float, int]:
+    """Measure the time to handle datagrams, in nanoseconds per datagram.
+
+    The login service is served on a loopback socket, with a handler doing
+    nothing, and a client sends it batches of ``DISPATCH_BATCH`` datagrams.
+    Measured time is the protocol's, the sockets' and the event loop's overhead,
+    client side included. Returns it with the number of lost datagrams.
+    """
+    message = login_request(udpservice.STNP_LOGIN_ANONYMOUS)
+
+    async def run() -> tuple[int, int]:
+        event_loop = asyncio.get_running_loop()
+        server_transport = await udpservice.serve(
+            0, workers=udp_workers, executor=executor
+        )
+        client_transport, client = await event_loop.create_datagram_endpoint(
+            _DispatchClient,
+            remote_addr=("127.0.0.1", server_transport.get_extra_info("sockname")[1]),
+        )
+        try:
+            begin_ns = time.perf_counter_ns()
+            nb_left = nb_datagrams
+            nb_lost = 0
+            while nb_left > 0:
+                batch_size = min(nb_left, DISPATCH_BATCH)
+                done = client.expect(batch_size)
+                for _ in range(batch_size):
+                    client_transport.sendto(message)
+                try:
+                    await asyncio.wait_for(done, TIMEOUT)
+                except asyncio.TimeoutError:
+                    nb_lost += client.nb_expected
+                nb_left -= batch_size
+            return (time.perf_counter_ns() - begin_ns, nb_lost)
+        finally:
+            client_transport.close()
+            server_transport.close()
+
+    event_loop = udpservice.new_event_loop(loop)
+    original_handlers = dict(udpservice.MESSAGE_HANDLERS)
+    udpservice.MESSAGE_HANDLERS[udpservice.STNP_LOGIN_ANONYMOUS] = (
+        lambda message: udpservice.logged_in_msg(0, udpservice.STNP_LOGIN_ANONYMOUS)
+    )
+    try:
+        duration_ns, nb_lost = event_loop.run_until_complete(run())
+        return (duration_ns / nb_datagrams, nb_lost)
+    finally:
+        udpservice.MESSAGE_HANDLERS.update(original_handlers)
+        event_loop.close()
+
+
+def _run_dispatch_benchmarks(nb_datagrams: int, udp_workers: int) -> None:
+    """Run and report the dispatch benchmark for each event loop."""
+    for loop in udpservice.LOOPS[1:]:
+        if not udpservice.is_loop_available(loop):
+            click.echo(f"{loop:>10}: not installed")
+            continue
+        threaded_ns, threaded_lost = _dispatch_benchmark(
+            loop, nb_datagrams, udp_workers, None
+        )
+        inline_ns, inline_lost = _dispatch_benchmark(
+            loop, nb_datagrams, udp_workers, _InlineExecutor()
+        )
+        click.echo(
+            f"{loop:>10}: {threaded_ns:8.0f} ns/datagram with worker threads,"
+            f" {inline_ns:8.0f} ns/datagram inline"
+            f" ({threaded_lost + inline_lost} lost)"
+        )
+
+
+@click.command()
+@click.option(
+    "--clients",
+    type=click.IntRange(min=1),
+    default=CLIENTS,
+    help="number of simulated clients",
+)
+@click.option(
+    "--duration",
+    type=click.FloatRange(min=0),
+    default=DURATION,
+    help="duration of the benchmark, in seconds",
+)
+@click.option(
+    "--mix",
+    type=str,
+    default=MIX,
+    help="relative weights of request types (anonymous, password, create)",
+)
+@click.option(
+    "--seed-users",
+    type=click.IntRange(min=0),
+    default=SEED_USERS,
+    help="number of users registered before the benchmark",
+)
+@click.option(
+    "--timeout",
+    type=click.FloatRange(min=0),
+    default=TIMEOUT,
+    help="delay after which a request is considered lost, in seconds",
+)
+@click.option(
+    "--db-backend",
+    type=click.Choice(logindb.BACKENDS),
+    default=DB_BACKEND,
+    help="storage of the login database [json, sqlite]",
+)
+@click.option(
+    "--udp-workers",
+    type=click.IntRange(min=1),
+    default=udpservice.WORKERS,
+    help="number of threads handling UDP login requests",
+)
+@click.option(
+    "--loop",
+    type=click.Choice(udpservice.LOOPS),
+    default=udpservice.LOOP,
+    help="event loop implementation of the server [auto, asyncio, uvloop]",
+)
+@click.option(
+    "--dispatch",
+    is_flag=True,
+    default=False,
+    help="only benchmark datagram dispatch under each event loop",
+)
+@click.option(
+    "--dispatch-datagrams",
+    type=click.IntRange(min=1),
+    default=DISPATCH_DATAGRAMS,
+    help="number of datagrams dispatched by each dispatch benchmark",
+)
+@click.option(
+    "--server-metrics/--no-server-metrics",
+    default=False,
+    help="print the metrics collected by the server",
+)
+def main(
+    clients: int,
+    duration: float,
+    mix: str,
+    seed_users: int,
+    timeout: float,
+    db_backend: str,
+    udp_workers: int,
+    loop: str,
+    dispatch: bool,
+    dispatch_datagrams: int,
+    server_metrics: bool,
+):
+    """Benchmark the UDP login service."""
+    if not udpservice.is_loop_available(loop):
+        raise click.UsageError(f"--loop {loop} is not installed")
+    if dispatch:
+        _run_dispatch_benchmarks(dispatch_datagrams, udp_workers)
+        return
+
+    weights = parse_mix(mix)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Start the server
+        parent_pipe, child_pipe = multiprocessing.Pipe()
+        server = multiprocessing.get_context("fork").Process(
+            target=_server_process,
+            args=(
+                Path(tmp_dir) / "login_db",
+                db_backend,
+                udp_workers,
+                seed_users,
+                loop,
+                child_pipe,
+            ),
+        )
+        server.start()
+        child_pipe.close()
+        port = parent_pipe.recv()
+
+        # Run clients
+        try:
+            results, timeouts, real_duration = asyncio.run(
+                _run_clients(port, clients, weights, seed_users, duration, timeout)
+            )
+        finally:
+            parent_pipe.send("stop")
+            collected_metrics = parent_pipe.recv()
+            server.join()
+
+    # Report
+    for kind in LOGIN_TYPES:
+        if weights.get(kind, 0) > 0:
+            _report(kind, results[kind], timeouts[kind], real_duration)
+    _report(
+        "total",
+        [sample for samples in results.values() for sample in samples],
+        sum(timeouts.values()),
+        real_duration,
+    )
+    if server_metrics:
+        click.echo(json.dumps(collected_metrics, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,16 +5,28 @@
 from __future__ import annotations
 
 import logging
+import multiprocessing
 from pathlib import Path
 
 import click
 
-from . import logindb, restservice
+from . import admission, logindb, responsecache, restservice, udpservice
 
 # Parameters' default
 LISTEN_PORT_UDP = 0x1234
 LISTEN_PORT_REST = 8124
+WORKERS = 1
+UDP_WORKERS = udpservice.WORKERS
+UDP_QUEUE_SIZE = udpservice.QUEUE_SIZE
+LOOP = udpservice.LOOP
+SOURCE_RATE = admission.SOURCE_RATE
+SOURCE_BURST = admission.SOURCE_BURST
+GLOBAL_RATE = admission.GLOBAL_RATE
+GLOBAL_BURST = admission.GLOBAL_BURST
+RESPONSE_CACHE_TTL = responsecache.TTL
 LOGIN_DB_FILE = Path("/var/lib/stb/login_server_db.json")
+DB_BACKEND = "json"
+SNAPSHOT_INTERVAL = logindb.SNAPSHOT_INTERVAL
 LOG_FILE = Path("/var/log/stb/login_server.log")
 LOG_LEVEL = "info"
 
@@ -32,12 +44,85 @@ LOG_LEVEL = "info"
     default=LISTEN_PORT_REST,
     help="port listening for REST requests",
 )
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=WORKERS,
+    help="number of processes serving the UDP port, more than one needs a db file"
+    " (metrics and UDP service stats only cover the first one)",
+)
+@click.option(
+    "--udp-workers",
+    type=click.IntRange(min=1),
+    default=UDP_WORKERS,
+    help="number of threads handling UDP login requests",
+)
+@click.option(
+    "--udp-queue-size",
+    type=click.IntRange(min=1),
+    default=UDP_QUEUE_SIZE,
+    help="maximum number of pending UDP login requests, extra ones are dropped",
+)
+@click.option(
+    "--loop",
+    type=click.Choice(udpservice.LOOPS),
+    default=LOOP,
+    help="event loop implementation [auto, asyncio, uvloop]",
+)
+@click.option(
+    "--source-rate",
+    type=click.FloatRange(min=0),
+    default=SOURCE_RATE,
+    help="UDP login requests per second allowed from one address, 0 for no limit",
+)
+@click.option(
+    "--source-burst",
+    type=click.FloatRange(min=1),
+    default=SOURCE_BURST,
+    help="UDP login requests allowed at once from one address",
+)
+@click.option(
+    "--global-rate",
+    type=click.FloatRange(min=0),
+    default=GLOBAL_RATE,
+    help="UDP login requests per second allowed per process, 0 for no limit",
+)
+@click.option(
+    "--global-burst",
+    type=click.FloatRange(min=1),
+    default=GLOBAL_BURST,
+    help="UDP login requests allowed at once per process",
+)
+@click.option(
+    "--response-cache-ttl",
+    type=click.FloatRange(min=0),
+    default=RESPONSE_CACHE_TTL,
+    help="seconds during which a retransmitted request gets the same response",
+)
 @click.option(
     "--db-file",
     type=Path,
     default=LOGIN_DB_FILE,
     help="file storing persistant login info, empty for no file",
 )
+@click.option(
+    "--db-backend",
+    type=click.Choice(logindb.BACKENDS),
+    default=DB_BACKEND,
+    help="storage of the login database [json, sqlite]",
+)
+@click.option(
+    "--migrate-json",
+    type=Path,
+    default=None,
+    help="import this json database in the sqlite --db-file, then exit",
+)
+@click.option(
+    "--snapshot-interval",
+    type=click.IntRange(min=0),
+    default=SNAPSHOT_INTERVAL,
+    help="number of journaled changes between two snapshots of the database",
+)
 @click.option(
     "--log-file",
     type=Path,
@@ -53,7 +138,19 @@ LOG_LEVEL = "info"
 def main(
     udp_port: int,
     rest_port: int,
+    workers: int,
+    udp_workers: int,
+    udp_queue_size: int,
+    loop: str,
+    source_rate: float,
+    source_burst: float,
+    global_rate: float,
+    global_burst: float,
+    response_cache_ttl: float,
     db_file: str,
+    db_backend: str,
+    migrate_json: Path | None,
+    snapshot_interval: int,
     log_file: Path,
     log_level: str,
 ):
@@ -68,13 +165,78 @@ def main(
         level=getattr(logging, log_level.upper()),
     )
 
+    db_file = db_file if db_file != "" else None
+    shared = workers > 1
+    if (shared or db_backend == "sqlite") and db_file is None:
+        raise click.UsageError("--db-file is needed by the sqlite backend or workers")
+    if not udpservice.is_loop_available(loop):
+        raise click.UsageError(f"--loop {loop} is not installed")
+
+    # Migrate database, if requested
+    if migrate_json is not None:
+        if db_backend != "sqlite":
+            raise click.UsageError("--migrate-json needs the sqlite backend")
+        logindb.migrate_to_sqlite(migrate_json, db_file)
+        return
+
+    admission_control = admission.AdmissionControl(
+        source_rate, source_burst, global_rate, global_burst
+    )
+    response_cache = (
+        responsecache.ResponseCache(response_cache_ttl)
+        if response_cache_ttl > 0
+        else None
+    )
+
+    # Start secondary UDP processes
+    for _ in range(workers - 1):
+        multiprocessing.get_context("fork").Process(
+            target=_udp_process,
+            args=(
+                db_file,
+                db_backend,
+                snapshot_interval,
+                udp_port,
+                udp_workers,
+                udp_queue_size,
+                loop,
+                admission_control,
+                response_cache,
+            ),
+            daemon=True,
+        ).start()
+
     # Initialize login database
-    logindb.load(db_file if db_file != "" else None)
+    logindb.load(db_file, snapshot_interval, shared=shared, backend=db_backend)
 
     # Start serving UDP and REST requests
     restservice.serve(
         rest_port,
         udp_port,
+        udp_workers=udp_workers,
+        udp_queue_size=udp_queue_size,
+        udp_reuse_port=shared,
+        udp_admission=admission_control,
+        udp_response_cache=response_cache,
+        loop=loop,
+    )
+
+
+def _udp_process(
+    db_file: Path,
+    db_backend: str,
+    snapshot_interval: int,
+    udp_port: int,
+    udp_workers: int,
+    udp_queue_size: int,
+    loop: str,
+    admission_control: admission.AdmissionControl,
+    response_cache: responsecache.ResponseCache | None,
+):
+    """Serve UDP login requests from a secondary process."""
+    logindb.load(db_file, snapshot_interval, shared=True, backend=db_backend)
+    udpservice.run_process(
+        udp_port, udp_workers, udp_queue_size, admission_control, response_cache, loop
     )
 
 
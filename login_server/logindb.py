@@ -1,19 +1,68 @@
-"""Login database management for Super Tilt Bro."""
+"""Login database management for Super Tilt Bro.
+
+The database is persisted as a binary snapshot plus an append-only journal. Each
+mutation is appended to the journal as one JSON line, the snapshot is rewritten
+(and the journal replaced by an empty one) every ``snapshot_interval`` journal
+entries, and loading replays the journal on top of the snapshot. Databases
+written as a JSON snapshot are still loaded, and converted on next snapshot.
+
+In memory, registered users are compact records, see :mod:`usertable`.
+
+Anonymous IDs are leased by blocks: the persisted ``next_anonymous_id`` is the
+end of the current lease, IDs of the lease are handed out from memory. IDs left
+unused by a crash are skipped, never reused.
+
+In shared mode, several processes can use the same database files. Accesses are
+serialized by a lock file, and each process applies the journal entries written
+by others before accessing the database.
+
+Alternatively, the database can be stored in SQLite, see :mod:`sqlitedb`.
+"""
 
 from __future__ import annotations
 
+import contextlib
+import fcntl
+import itertools
 import json
+import logging
+import os
 import threading
+import time
 from pathlib import Path
+from typing import BinaryIO, Iterator, TextIO
+
+from sortedcontainers import SortedList
+
+from . import metrics, sqlitedb, usertable
+from .usertable import UserRecord
+
+# Parameters' default
+SNAPSHOT_INTERVAL = 10000
+ANONYMOUS_ID_LEASE = 1000
+SEARCH_LIMIT = 50
+
+BACKENDS = ["json", "sqlite"]
 
 #
 # Working structures
 #
 
+_backend = "json"
 _db_file: Path | None = None
 _db_mutex = threading.Lock()
+_journal: BinaryIO | None = None
+_journal_offset = 0
+_journal_entries = 0
+_journal_torn = False
+_snapshot_interval = SNAPSHOT_INTERVAL
+_lock_file: TextIO | None = None
+_user_names: dict[int, str] = {}
+_sorted_user_names = SortedList()
+_next_anonymous_id = 0
+_anonymous_ids_left = 0
 
-user_db = {
+user_db: dict = {
     "registered_logins": {},
     "next_anonymous_id": 0,
     "next_registered_id": 0x80000000,
@@ -24,78 +73,407 @@ user_db = {
 #
 
 
+def _journal_path(db_file: Path) -> Path:
+    """Get the path of the journal associated to a database file."""
+    return Path(f"{db_file}.journal")
+
+
+def _lock_path(db_file: Path) -> Path:
+    """Get the path of the lock file associated to a database file."""
+    return Path(f"{db_file}.lock")
+
+
 def _new_registered_user_id() -> int:
     """Get a new registered user ID."""
     global user_db
     new_id = user_db["next_registered_id"]
     assert new_id < 0x100000000
-    user_db["next_registered_id"] += 1
     return new_id
 
 
+def _index_user_names() -> None:
+    """Rebuild the user ID to user name index, and the sorted user names."""
+    global _sorted_user_names, _user_names, user_db
+    _user_names = {
+        user_record.user_id: user_name
+        for user_name, user_record in user_db["registered_logins"].items()
+    }
+    _sorted_user_names = SortedList(user_db["registered_logins"])
+
+
+def _apply(entry: dict) -> None:
+    """Apply a journal entry to the in-memory database."""
+    global _sorted_user_names, _user_names, user_db
+    if entry["op"] == "register":
+        if entry["user"] not in user_db["registered_logins"]:
+            _sorted_user_names.add(entry["user"])
+        user_db["registered_logins"][entry["user"]] = UserRecord(
+            usertable.pack_password(entry["password"]), entry["user_id"]
+        )
+        _user_names[entry["user_id"]] = entry["user"]
+        user_db["next_registered_id"] = max(
+            user_db["next_registered_id"], entry["user_id"] + 1
+        )
+    elif entry["op"] == "anonymous":
+        user_db["next_anonymous_id"] = entry["next_anonymous_id"]
+    else:
+        raise Exception(f'unknown journal operation "{entry["op"]}"')
+
+
+def _commit(entry: dict) -> None:
+    """Apply a mutation and record it in the journal."""
+    global _journal, _journal_entries, _journal_offset, _journal_torn
+    global _snapshot_interval
+    _apply(entry)
+    if _journal is not None:
+        serialized_entry = (json.dumps(entry, separators=(",", ":")) + "\n").encode()
+        if _journal_torn:
+            # Do not append to an entry left incomplete by a crash
+            serialized_entry = b"\n" + serialized_entry
+            _journal_torn = False
+        with metrics.timed("journal_append"):
+            _journal.write(serialized_entry)
+            _journal.flush()
+        _journal_offset += len(serialized_entry)
+        _journal_entries += 1
+        if _journal_entries >= _snapshot_interval:
+            _sync_db()
+
+
+def _read_db_file(db_file: Path) -> dict:
+    """Read a database snapshot, binary or JSON."""
+    if usertable.is_snapshot(db_file):
+        return usertable.read_snapshot(db_file)
+    with db_file.open() as f:
+        return usertable.from_json(json.load(f))
+
+
+def _apply_journal_line(line: bytes) -> bool:
+    """Apply a serialized journal entry, return False if it is corrupted."""
+    try:
+        entry = json.loads(line)
+    except json.JSONDecodeError:
+        # Most likely a write interrupted by a crash
+        logging.warning("ignored corrupted journal entry: %s", line)
+        return False
+    _apply(entry)
+    return True
+
+
+def _replay_journal() -> int:
+    """Apply journal entries not yet applied, return the number of entries."""
+    global _journal, _journal_entries, _journal_offset, _journal_torn
+    assert _journal is not None
+    nb_entries = 0
+    _journal.seek(_journal_offset)
+    for line in _journal:
+        _journal_offset += len(line)
+        _journal_torn = not line.endswith(b"\n")
+        if _apply_journal_line(line):
+            nb_entries += 1
+    _journal_entries += nb_entries
+    return nb_entries
+
+
+def _load_files() -> int:
+    """Load the snapshot and replay the journal, return the number of entries."""
+    global _db_file, _journal, _journal_entries, _journal_offset, _journal_torn
+    global user_db
+    assert _db_file is not None
+    if _db_file.is_file():
+        user_db = _read_db_file(_db_file)
+    _index_user_names()
+
+    if _journal is not None:
+        _journal.close()
+    _journal = _journal_path(_db_file).open("a+b")
+    _journal_offset = 0
+    _journal_entries = 0
+    _journal_torn = False
+    nb_entries = _replay_journal()
+    logging.info("replayed %d journal entries", nb_entries)
+    return nb_entries
+
+
+def _catch_up() -> None:
+    """Apply changes made to the database files by other processes."""
+    global _db_file, _journal, _journal_offset
+    assert _db_file is not None
+    assert _journal is not None
+    journal_stat = _journal_path(_db_file).stat()
+    if journal_stat.st_ino != os.fstat(_journal.fileno()).st_ino:
+        # Another process compacted the journal in a new snapshot
+        _load_files()
+    elif journal_stat.st_size > _journal_offset:
+        _replay_journal()
+
+
+@contextlib.contextmanager
+def _locked() -> Iterator[None]:
+    """Hold ``_db_mutex``, recording the time spent waiting for it."""
+    global _db_mutex
+    begin_ns = time.perf_counter_ns()
+    with _db_mutex:
+        metrics.record("db_mutex_wait", time.perf_counter_ns() - begin_ns)
+        yield
+
+
+@contextlib.contextmanager
+def _files_access(write: bool) -> Iterator[None]:
+    """Lock the database files and catch up with other processes.
+
+    Does nothing if not in shared mode, ``_db_mutex`` must be held.
+    """
+    global _lock_file
+    if _lock_file is None:
+        yield
+        return
+
+    begin_ns = time.perf_counter_ns()
+    fcntl.flock(_lock_file, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+    metrics.record("db_file_lock_wait", time.perf_counter_ns() - begin_ns)
+    try:
+        _catch_up()
+        yield
+    finally:
+        fcntl.flock(_lock_file, fcntl.LOCK_UN)
+
+
 def _sync_db() -> None:
-    """Synchronize the database with the file."""
-    global _db_file, user_db
+    """Synchronize the database with the file.
+
+    Write a full snapshot of the database, then start a new empty journal.
+    """
+    global _db_file, _journal, _journal_entries, _journal_offset, _journal_torn
+    global _sorted_user_names, user_db
     if _db_file is not None:
+        begin_ns = time.perf_counter_ns()
         tmp_db_path = Path(f"{_db_file}.tmp")
-        with tmp_db_path.open("w") as tmp_db:
-            json.dump(user_db, tmp_db)
+        usertable.write_snapshot(tmp_db_path, user_db, _sorted_user_names)
         tmp_db_path.replace(_db_file)
 
+        if _journal is not None:
+            _journal.close()
+        journal_path = _journal_path(_db_file)
+        tmp_journal_path = Path(f"{journal_path}.tmp")
+        tmp_journal_path.open("w").close()
+        tmp_journal_path.replace(journal_path)
+        _journal = journal_path.open("a+b")
+        _journal_offset = 0
+        _journal_entries = 0
+        _journal_torn = False
+        metrics.record("sync_db", time.perf_counter_ns() - begin_ns)
+
+
+def _open_files(db_file: Path, shared: bool) -> None:
+    """Load the database files, then compact the journal if not empty.
+
+    In shared mode, the files are locked while loaded. ``_db_mutex`` must be held.
+    """
+    global _lock_file
+    if shared:
+        _lock_file = _lock_path(db_file).open("a")
+        fcntl.flock(_lock_file, fcntl.LOCK_EX)
+    try:
+        # Compact the journal, if there is anything to compact
+        if _load_files() > 0:
+            _sync_db()
+    finally:
+        if _lock_file is not None:
+            fcntl.flock(_lock_file, fcntl.LOCK_UN)
+
 
 #
 # Public API
 #
 
 
-def load(db_file: str | Path | None) -> None:
-    """Load the database from the given file."""
-    global _db_file, _db_mutex, user_db
+def load(
+    db_file: str | Path | None,
+    snapshot_interval: int = SNAPSHOT_INTERVAL,
+    shared: bool = False,
+    backend: str = "json",
+) -> None:
+    """Load the database from the given file.
+
+    With the "json" backend, the journal of mutations done since the last
+    snapshot is replayed, then compacted into a new snapshot if not empty.
+
+    In shared mode, the database files may be used concurrently by other
+    processes which loaded it in shared mode. The "sqlite" backend always
+    supports it.
+    """
+    global _anonymous_ids_left, _backend, _db_file, _db_mutex, _journal, _lock_file
+    global _snapshot_interval
     if isinstance(db_file, str):
         db_file = Path(db_file)
+    if backend not in BACKENDS:
+        raise Exception(f'unknown database backend "{backend}"')
+    if (shared or backend == "sqlite") and db_file is None:
+        raise Exception(f"{backend} backend needs a database file")
+
+    _backend = backend
+    if backend == "sqlite":
+        sqlitedb.load(db_file, ANONYMOUS_ID_LEASE)
+        return
+
     with _db_mutex:
         _db_file = db_file
+        _snapshot_interval = snapshot_interval
+        _anonymous_ids_left = 0
+        if _journal is not None:
+            _journal.close()
+            _journal = None
+        if _lock_file is not None:
+            _lock_file.close()
+            _lock_file = None
 
-        if db_file is not None and db_file.is_file():
-            with db_file.open() as f:
-                user_db = json.load(f)
+        if db_file is None:
+            _index_user_names()
+            return
+        _open_files(db_file, shared)
 
 
 def get_anonymous_id() -> int:
     """Get a new anonymous user ID."""
-    global _db_mutex, user_db
-    with _db_mutex:
-        new_id = user_db["next_anonymous_id"]
-        user_db["next_anonymous_id"] = (user_db["next_anonymous_id"] + 1) % 0x80000000
-        _sync_db()
+    global _anonymous_ids_left, _backend, _next_anonymous_id, user_db
+    if _backend == "sqlite":
+        return sqlitedb.get_anonymous_id()
+    with _locked():
+        if _anonymous_ids_left == 0:
+            with _files_access(write=True):
+                lease_begin = user_db["next_anonymous_id"]
+                _commit(
+                    {
+                        "op": "anonymous",
+                        "next_anonymous_id": (lease_begin + ANONYMOUS_ID_LEASE)
+                        % 0x80000000,
+                    }
+                )
+            _next_anonymous_id = lease_begin
+            _anonymous_ids_left = ANONYMOUS_ID_LEASE
+
+        new_id = _next_anonymous_id
+        _next_anonymous_id = (new_id + 1) % 0x80000000
+        _anonymous_ids_left -= 1
         return new_id
 
 
 def get_user_info(username: str) -> dict | None:
     """Get the user info for the given user name."""
-    global _db_mutex, user_db
-    with _db_mutex:
-        _sync_db()
-        return user_db["registered_logins"].get(username)
+    global _backend, user_db
+    if _backend == "sqlite":
+        return sqlitedb.get_user_info(username)
+    with _locked(), _files_access(write=False):
+        user_record = user_db["registered_logins"].get(username)
+        return None if user_record is None else user_record.to_dict()
 
 
 def get_user_name(user_id: int) -> str | None:
     """Get the user name for the given user ID."""
-    global _db_mutex, user_db
-    with _db_mutex:
-        for user_name, user_info in user_db["registered_logins"].items():
-            if user_info["user_id"] == user_id:
-                return user_name
-        return None
+    global _backend, _user_names
+    if _backend == "sqlite":
+        return sqlitedb.get_user_name(user_id)
+    with _locked(), _files_access(write=False):
+        return _user_names.get(user_id)
+
+
+def get_user_names(user_ids: list[int]) -> dict[int, str]:
+    """Get the user names of the given user IDs, unknown IDs are omitted."""
+    global _backend, _user_names
+    if _backend == "sqlite":
+        return sqlitedb.get_user_names(user_ids)
+    with _locked(), _files_access(write=False):
+        user_names = _user_names
+        return {
+            user_id: user_names[user_id]
+            for user_id in user_ids
+            if user_id in user_names
+        }
+
+
+def search_user_names(
+    prefix: str, offset: int = 0, limit: int = SEARCH_LIMIT
+) -> list[tuple[str, int]]:
+    """Get (user name, user ID) of users whose name begins with the prefix.
+
+    Users are sorted by name, ``offset`` and ``limit`` select a page of them.
+    """
+    global _backend, _sorted_user_names, user_db
+    if _backend == "sqlite":
+        return sqlitedb.search_user_names(prefix, offset, limit)
+    with _locked(), _files_access(write=False):
+        sorted_user_names = _sorted_user_names
+        begin = sorted_user_names.bisect_left(prefix) + offset
+        user_names = itertools.takewhile(
+            lambda user_name: user_name.startswith(prefix),
+            sorted_user_names.islice(begin, begin + limit),
+        )
+        users = user_db["registered_logins"]
+        return [(user_name, users[user_name].user_id) for user_name in user_names]
 
 
 def register_user(username: str, password: str) -> None:
     """Register a new user."""
+    global _backend, user_db
+    if _backend == "sqlite":
+        sqlitedb.register_user(username, password)
+        return
+    with _locked(), _files_access(write=True):
+        assert username not in user_db["registered_logins"]
+        _commit(
+            {
+                "op": "register",
+                "user": username,
+                "password": password,
+                "user_id": _new_registered_user_id(),
+            }
+        )
+
+
+def get_or_register_user(username: str, password: str) -> tuple[dict, bool]:
+    """Get the user info for the given user name, registering the user if needed.
+
+    Returns the user info, and whether the user has been registered. Concurrent
+    calls for the same new user name register it once.
+    """
+    global _backend, user_db
+    if _backend == "sqlite":
+        return sqlitedb.get_or_register_user(username, password)
+    user_info = get_user_info(username)
+    if user_info is not None:
+        return (user_info, False)
+
+    # The user may have been registered since, check again with write access
+    with _locked(), _files_access(write=True):
+        user_record = user_db["registered_logins"].get(username)
+        if user_record is not None:
+            return (user_record.to_dict(), False)
+        _commit(
+            {
+                "op": "register",
+                "user": username,
+                "password": password,
+                "user_id": _new_registered_user_id(),
+            }
+        )
+        return (user_db["registered_logins"][username].to_dict(), True)
+
+
+def migrate_to_sqlite(json_db_file: str | Path, sqlite_db_file: str | Path) -> None:
+    """Copy a database from the "json" backend to a new "sqlite" backend.
+
+    The "json" database files are only read, not compacted.
+    """
     global _db_mutex, user_db
+    json_db_file = Path(json_db_file)
     with _db_mutex:
-        assert username not in user_db["registered_logins"]
-        user_db["registered_logins"][username] = {
-            "password": password,
-            "user_id": _new_registered_user_id(),
-        }
-        _sync_db()
+        user_db = _read_db_file(json_db_file)
+        _index_user_names()
+        journal_path = _journal_path(json_db_file)
+        if journal_path.is_file():
+            with journal_path.open("rb") as journal:
+                for line in journal:
+                    _apply_journal_line(line)
+    sqlitedb.load(sqlite_db_file, ANONYMOUS_ID_LEASE)
+    sqlitedb.import_db(usertable.to_json(user_db))
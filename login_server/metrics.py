@@ -0,0 +1,110 @@
+"""Low overhead latency metrics for the login server.
+
+Durations are recorded in nanoseconds, in histograms with power of two buckets.
+Recording is a few integer operations without locking: concurrent updates from
+several threads may rarely lose a sample, which is acceptable for monitoring.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import time
+from typing import Iterator
+
+NB_BUCKETS = 64
+
+#
+# Working structures
+#
+
+_start_time = time.monotonic()
+_histograms: dict[str, Histogram] = {}
+
+#
+# Implementation
+#
+
+
+class Histogram:
+    """Histogram of durations.
+
+    Bucket ``i`` counts durations ``d`` such as ``2**(i-1) <= d < 2**i`` ns.
+    """
+
+    __slots__ = ("buckets", "count", "total_ns", "max_ns")
+
+    def __init__(self) -> None:
+        """Initialize an empty histogram."""
+        self.buckets = [0] * NB_BUCKETS
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, duration_ns: int) -> None:
+        """Record a duration."""
+        self.buckets[duration_ns.bit_length()] += 1
+        self.count += 1
+        self.total_ns += duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    def percentile_ns(self, ratio: float) -> int:
+        """Get an upper bound of the given percentile, ratio in [0, 1]."""
+        threshold = ratio * self.count
+        seen = 0
+        for bucket_index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= threshold and seen > 0:
+                return min(1 << bucket_index, self.max_ns)
+        return self.max_ns
+
+    def to_dict(self) -> dict:
+        """Summarize the histogram, durations in microseconds."""
+        return {
+            "count": self.count,
+            "mean_us": self.total_ns / self.count / 1000 if self.count else 0,
+            "p50_us": self.percentile_ns(0.5) / 1000,
+            "p99_us": self.percentile_ns(0.99) / 1000,
+            "p999_us": self.percentile_ns(0.999) / 1000,
+            "max_us": self.max_ns / 1000,
+        }
+
+
+#
+# Public API
+#
+
+
+def record(name: str, duration_ns: int) -> None:
+    """Record a duration in the named histogram."""
+    histogram = _histograms.get(name)
+    if histogram is None:
+        histogram = _histograms.setdefault(name, Histogram())
+    histogram.record(duration_ns)
+
+
+@contextlib.contextmanager
+def timed(name: str) -> Iterator[None]:
+    """Record the duration of a block in the named histogram."""
+    begin = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter_ns() - begin)
+
+
+def get_metrics() -> dict:
+    """Get a summary of all histograms."""
+    return {
+        "uptime_s": time.monotonic() - _start_time,
+        "histograms": {
+            name: histogram.to_dict() for name, histogram in list(_histograms.items())
+        },
+    }
+
+
+def reset() -> None:
+    """Forget all recorded durations."""
+    global _start_time
+    _start_time = time.monotonic()
+    _histograms.clear()
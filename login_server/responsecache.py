@@ -0,0 +1,90 @@
+"""Cache of responses to retransmitted login requests.
+
+STNP clients repeat their login request until they get a response. Responses
+are cached for a short time by client address and request content, so that a
+retransmitted request gets the exact same response without being handled
+again. Requests identical to one being handled are ignored.
+"""
+
+from __future__ import annotations
+
+import collections
+import time
+from typing import Tuple
+
+# Parameters' default
+TTL = 5.0
+MAX_ENTRIES = 65536
+
+CacheKey = Tuple[Tuple[str, int], bytes]
+
+
+class ResponseCache:
+    """Bounded cache of recent responses.
+
+    Entries are kept in insertion order, which is also expiration order, so
+    eviction only looks at the oldest entries.
+    """
+
+    def __init__(self, ttl: float = TTL, max_entries: int = MAX_ENTRIES) -> None:
+        """Initialize an empty cache."""
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: collections.OrderedDict[CacheKey, tuple[float, bytes]] = (
+            collections.OrderedDict()
+        )
+        self._in_flight: set[CacheKey] = set()
+        self.nb_hits = 0
+        self.nb_in_flight_hits = 0
+
+    def lookup(self, key: CacheKey) -> bytes | None:
+        """Get the response to replay for a request, if any.
+
+        Returns an empty response for a request currently being handled, None
+        if the request must be handled. In the latter case, the request is
+        considered in flight until ``store`` or ``abort`` is called.
+        """
+        now = time.monotonic()
+        self._evict(now)
+
+        if key in self._in_flight:
+            self.nb_in_flight_hits += 1
+            return b""
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.nb_hits += 1
+            return entry[1]
+
+        self._in_flight.add(key)
+        return None
+
+    def store(self, key: CacheKey, response: bytes) -> None:
+        """Store the response of an in flight request."""
+        self._in_flight.discard(key)
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def abort(self, key: CacheKey) -> None:
+        """Forget an in flight request which got no response."""
+        self._in_flight.discard(key)
+
+    def _evict(self, now: float) -> None:
+        """Remove expired entries."""
+        entries = self._entries
+        while entries:
+            oldest_key = next(iter(entries))
+            if entries[oldest_key][0] > now:
+                break
+            del entries[oldest_key]
+
+    def get_stats(self) -> dict:
+        """Get cache statistics."""
+        return {
+            "entries": len(self._entries),
+            "in_flight": len(self._in_flight),
+            "hits": self.nb_hits,
+            "in_flight_hits": self.nb_in_flight_hits,
+        }
@@ -1,12 +1,23 @@
-"""REST API for login service."""
+"""REST API for login service.
+
+Handlers accessing the database are plain functions, run by FastAPI in its
+thread pool, so that a slow database access never blocks the event loop.
+"""
 
 from __future__ import annotations
 
 import asyncio
+import os
+
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse
 
-from fastapi import FastAPI, HTTPException, Request
+from . import logindb, metrics, udpservice
+from .admission import AdmissionControl
+from .responsecache import ResponseCache
 
-from . import logindb, udpservice
+# Maximum number of users returned by one search
+SEARCH_MAX_LIMIT = 1000
 
 app = FastAPI()
 
@@ -14,7 +25,16 @@ app = FastAPI()
 @app.on_event("startup")
 async def startup_event():
     """Start the UDP service."""
-    return asyncio.create_task(udpservice.serve(listen_port=app.state.udp_port))
+    return asyncio.create_task(
+        udpservice.serve(
+            listen_port=app.state.udp_port,
+            workers=app.state.udp_workers,
+            queue_size=app.state.udp_queue_size,
+            reuse_port=app.state.udp_reuse_port,
+            admission=app.state.udp_admission,
+            response_cache=app.state.udp_response_cache,
+        )
+    )
 
 
 @app.middleware("http")
@@ -26,7 +46,7 @@ async def check_addr(request: Request, call_next):
 
 
 @app.get("/api/login/user_name/{user_id}")
-async def get_user_name(user_id: int) -> str:
+def get_user_name(user_id: int) -> str:
     """Return the user name for the given user ID."""
     try:
         user_name = logindb.get_user_name(user_id)
@@ -38,10 +58,99 @@ async def get_user_name(user_id: int) -> str:
     return user_name
 
 
-def serve(rest_port: int, udp_port: int, whitelist=None):
-    """Serve the login service on the given port."""
+@app.post("/api/login/user_names")
+def post_user_names(user_ids: list[int]) -> JSONResponse:
+    """Return the user names of the given user IDs.
+
+    The response maps user IDs to user names, unknown user IDs are omitted.
+    """
+    try:
+        user_names = logindb.get_user_names(user_ids)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+    return JSONResponse(
+        {str(user_id): user_name for user_id, user_name in user_names.items()}
+    )
+
+
+@app.get("/api/login/users")
+def get_users(
+    prefix: str = "",
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=logindb.SEARCH_LIMIT, ge=1, le=SEARCH_MAX_LIMIT),
+) -> dict:
+    """Search users by name prefix.
+
+    Users are sorted by name, the response's "next_offset" is the offset of the
+    next page, null on the last page.
+    """
+    try:
+        users = logindb.search_user_names(prefix, offset, limit + 1)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+    return {
+        "users": [
+            {"user_name": user_name, "user_id": user_id}
+            for user_name, user_id in users[:limit]
+        ],
+        "next_offset": offset + limit if len(users) > limit else None,
+    }
+
+
+def _process_local(stats: dict) -> dict:
+    """Label statistics as covering only the current process.
+
+    With several workers, other processes serving the UDP port handle their
+    share of the requests, they are not included.
+    """
+    return {"scope": "process", "pid": os.getpid(), **stats}
+
+
+@app.get("/api/login/udp_service")
+async def get_udp_service() -> dict:
+    """Return the state of the UDP login service's work queue.
+
+    Only covers the process serving REST requests, see ``_process_local``.
+    """
+    stats = udpservice.get_stats()
+    if stats is None:
+        raise HTTPException(status_code=503, detail="UDP service not started")
+    return _process_local(stats)
+
+
+@app.get("/api/login/metrics")
+def get_metrics() -> dict:
+    """Return latency histograms of the login server.
+
+    Only covers the process serving REST requests, see ``_process_local``.
+    """
+    return _process_local(metrics.get_metrics())
+
+
+def serve(
+    rest_port: int,
+    udp_port: int,
+    whitelist=None,
+    udp_workers: int = udpservice.WORKERS,
+    udp_queue_size: int = udpservice.QUEUE_SIZE,
+    udp_reuse_port: bool = False,
+    udp_admission: AdmissionControl | None = None,
+    udp_response_cache: ResponseCache | None = None,
+    loop: str = udpservice.LOOP,
+):
+    """Serve the login service on the given port.
+
+    ``loop`` is the event loop implementation, see ``udpservice.LOOPS``.
+    """
     import uvicorn
 
     app.state.udp_port = udp_port
+    app.state.udp_workers = udp_workers
+    app.state.udp_queue_size = udp_queue_size
+    app.state.udp_reuse_port = udp_reuse_port
+    app.state.udp_admission = udp_admission
+    app.state.udp_response_cache = udp_response_cache
     app.state.addr_white_list = whitelist
-    uvicorn.run(app, host="0.0.0.0", port=rest_port)
+    uvicorn.run(app, host="0.0.0.0", port=rest_port, loop=loop)
@@ -0,0 +1,249 @@
+"""SQLite storage backend for the login database.
+
+Provides the same API as :mod:`logindb`, which delegates to this module when
+loaded with the "sqlite" backend. The database is opened in WAL mode, each
+thread has its own connection, and transactions serialize writers even when
+several processes use the same file.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Iterator
+
+# Maximum number of values bound in one query
+QUERY_MAX_VALUES = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS registered_logins (
+    user_name TEXT NOT NULL,
+    password TEXT NOT NULL,
+    user_id INTEGER NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS registered_logins_user_name
+    ON registered_logins (user_name);
+CREATE UNIQUE INDEX IF NOT EXISTS registered_logins_user_id
+    ON registered_logins (user_id);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters (name, value) VALUES
+    ('next_anonymous_id', 0),
+    ('next_registered_id', 2147483648);
+"""
+
+#
+# Working structures
+#
+
+_db_file: Path | None = None
+_db_mutex = threading.Lock()
+_connections = threading.local()
+_anonymous_id_lease = 1
+_next_anonymous_id = 0
+_anonymous_ids_left = 0
+
+#
+# Internal utilities
+#
+
+
+def _connection() -> sqlite3.Connection:
+    """Get the connection of the current thread."""
+    global _connections, _db_file
+    assert _db_file is not None
+    connection = getattr(_connections, "connection", None)
+    if connection is None:
+        connection = sqlite3.connect(_db_file, isolation_level=None, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        _connections.connection = connection
+    return connection
+
+
+@contextlib.contextmanager
+def _transaction() -> Iterator[sqlite3.Connection]:
+    """Run a write transaction on the connection of the current thread."""
+    connection = _connection()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+def _get_counter(connection: sqlite3.Connection, name: str) -> int:
+    """Read a counter, must be called in a transaction."""
+    return connection.execute(
+        "SELECT value FROM counters WHERE name = ?", (name,)
+    ).fetchone()[0]
+
+
+def _set_counter(connection: sqlite3.Connection, name: str, value: int) -> None:
+    """Write a counter, must be called in a transaction."""
+    connection.execute("UPDATE counters SET value = ? WHERE name = ?", (value, name))
+
+
+#
+# Public API
+#
+
+
+def load(db_file: str | Path, anonymous_id_lease: int = 1) -> None:
+    """Open the database, creating it if needed."""
+    global _anonymous_id_lease, _anonymous_ids_left, _connections, _db_file
+    if isinstance(db_file, str):
+        db_file = Path(db_file)
+    with _db_mutex:
+        _db_file = db_file
+        _connections = threading.local()
+        _anonymous_id_lease = anonymous_id_lease
+        _anonymous_ids_left = 0
+        _connection().executescript(SCHEMA)
+
+
+def import_db(user_db: dict) -> None:
+    """Import the content of a JSON login database in an empty database."""
+    with _transaction() as connection:
+        if connection.execute("SELECT COUNT(*) FROM registered_logins").fetchone()[0]:
+            raise Exception("cannot import in a non-empty database")
+        connection.executemany(
+            "INSERT INTO registered_logins (user_name, password, user_id)"
+            " VALUES (?, ?, ?)",
+            (
+                (user_name, user_info["password"], user_info["user_id"])
+                for user_name, user_info in user_db["registered_logins"].items()
+            ),
+        )
+        _set_counter(connection, "next_anonymous_id", user_db["next_anonymous_id"])
+        _set_counter(connection, "next_registered_id", user_db["next_registered_id"])
+
+
+def get_anonymous_id() -> int:
+    """Get a new anonymous user ID."""
+    global _anonymous_ids_left, _db_mutex, _next_anonymous_id
+    with _db_mutex:
+        if _anonymous_ids_left == 0:
+            with _transaction() as connection:
+                lease_begin = _get_counter(connection, "next_anonymous_id")
+                _set_counter(
+                    connection,
+                    "next_anonymous_id",
+                    (lease_begin + _anonymous_id_lease) % 0x80000000,
+                )
+            _next_anonymous_id = lease_begin
+            _anonymous_ids_left = _anonymous_id_lease
+
+        new_id = _next_anonymous_id
+        _next_anonymous_id = (new_id + 1) % 0x80000000
+        _anonymous_ids_left -= 1
+        return new_id
+
+
+def get_user_info(username: str) -> dict | None:
+    """Get the user info for the given user name."""
+    row = (
+        _connection()
+        .execute(
+            "SELECT password, user_id FROM registered_logins WHERE user_name = ?",
+            (username,),
+        )
+        .fetchone()
+    )
+    if row is None:
+        return None
+    return {"password": row[0], "user_id": row[1]}
+
+
+def get_user_name(user_id: int) -> str | None:
+    """Get the user name for the given user ID."""
+    row = (
+        _connection()
+        .execute(
+            "SELECT user_name FROM registered_logins WHERE user_id = ?", (user_id,)
+        )
+        .fetchone()
+    )
+    if row is None:
+        return None
+    return row[0]
+
+
+def get_user_names(user_ids: list[int]) -> dict[int, str]:
+    """Get the user names of the given user IDs, unknown IDs are omitted."""
+    connection = _connection()
+    user_names = {}
+    for chunk_begin in range(0, len(user_ids), QUERY_MAX_VALUES):
+        chunk = user_ids[chunk_begin : chunk_begin + QUERY_MAX_VALUES]
+        user_names.update(
+            connection.execute(
+                "SELECT user_id, user_name FROM registered_logins"
+                f" WHERE user_id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+        )
+    return user_names
+
+
+def search_user_names(prefix: str, offset: int, limit: int) -> list[tuple[str, int]]:
+    """Get (user name, user ID) of users whose name begins with the prefix."""
+    if prefix == "":
+        condition = ""
+        values: list = []
+    else:
+        # Names beginning with the prefix are between it and its successor
+        condition = " WHERE user_name >= ? AND user_name < ?"
+        values = [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+    return list(
+        _connection().execute(
+            "SELECT user_name, user_id FROM registered_logins"
+            f"{condition} ORDER BY user_name LIMIT ? OFFSET ?",
+            [*values, limit, offset],
+        )
+    )
+
+
+def _insert_user(connection: sqlite3.Connection, username: str, password: str) -> int:
+    """Insert a new user, must be called in a transaction, return its user ID."""
+    user_id = _get_counter(connection, "next_registered_id")
+    assert user_id < 0x100000000
+    connection.execute(
+        "INSERT INTO registered_logins (user_name, password, user_id)"
+        " VALUES (?, ?, ?)",
+        (username, password, user_id),
+    )
+    _set_counter(connection, "next_registered_id", user_id + 1)
+    return user_id
+
+
+def register_user(username: str, password: str) -> None:
+    """Register a new user."""
+    with _transaction() as connection:
+        _insert_user(connection, username, password)
+
+
+def get_or_register_user(username: str, password: str) -> tuple[dict, bool]:
+    """Get the user info for the given user name, registering the user if needed.
+
+    Returns the user info, and whether the user has been registered.
+    """
+    user_info = get_user_info(username)
+    if user_info is not None:
+        return (user_info, False)
+
+    # The user may have been registered since, check again in the transaction
+    with _transaction() as connection:
+        row = connection.execute(
+            "SELECT password, user_id FROM registered_logins WHERE user_name = ?",
+            (username,),
+        ).fetchone()
+        if row is not None:
+            return ({"password": row[0], "user_id": row[1]}, False)
+        user_id = _insert_user(connection, username, password)
+    return ({"password": password, "user_id": user_id}, True)
@@ -0,0 +1,60 @@
+"""Encoding of strings in STNP login messages.
+
+STNP strings are sequences of indexes in ``STNP_LOGIN_CHARSET``. Conversions are
+done by translation tables, so that no per-character Python code is executed.
+"""
+
+from __future__ import annotations
+
+import string
+
+STNP_LOGIN_CHARSET = [
+    " ",
+    *string.ascii_lowercase,
+    *string.digits,
+    None,
+]
+
+#
+# Translation tables
+#
+
+# Valid characters, in ASCII, indexed by their STNP code
+_CHARSET_ASCII = "".join(c for c in STNP_LOGIN_CHARSET if c is not None).encode(
+    "ascii"
+)
+
+# STNP code to ASCII
+_DECODE_TABLE = bytes(_CHARSET_ASCII) + bytes(256 - len(_CHARSET_ASCII))
+
+# ASCII to STNP code
+_ENCODE_TABLE = bytearray(256)
+for _code, _char in enumerate(_CHARSET_ASCII):
+    _ENCODE_TABLE[_char] = _code
+_ENCODE_TABLE = bytes(_ENCODE_TABLE)
+
+# STNP codes allowed in a string, to be deleted when checking validity
+_VALID_CODES = bytes(range(len(_CHARSET_ASCII)))
+
+#
+# Public API
+#
+
+
+def encode_str(value: str) -> bytes:
+    """Encode a string in STNP charset."""
+    ascii_value = value.encode("ascii")
+    if ascii_value.translate(None, _CHARSET_ASCII):
+        raise ValueError(f'unencodable STNP string: "{value}"')
+    return ascii_value.translate(_ENCODE_TABLE)
+
+
+def decode_str(value: bytes | memoryview) -> str | None:
+    """Decode a zero-terminated STNP string, return None if it is invalid."""
+    value = bytes(value)
+    end = value.find(0)
+    if end != -1:
+        value = value[:end]
+    if value.translate(None, _VALID_CODES):
+        return None
+    return value.translate(_DECODE_TABLE).decode("ascii")
@@ -3,13 +3,29 @@
 from __future__ import annotations
 
 import asyncio
+import contextlib
+import functools
+import importlib.util
 import logging
-import string
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, cast
 
-from . import logindb
+from . import logindb, metrics
+from .admission import AdmissionControl
+from .responsecache import ResponseCache
+from .stnpcodec import decode_str, encode_str
 
 MESSAGE_LEN = 72
 
+# Parameters' default
+WORKERS = 4
+QUEUE_SIZE = 1024
+LOOP = "auto"
+
+# Event loop implementations, "auto" is uvloop if installed, asyncio otherwise
+LOOPS = ["auto", "asyncio", "uvloop"]
+
 #
 # STNP, login extension
 #
@@ -23,13 +39,14 @@ STNP_LOGIN_ANONYMOUS = 0
 STNP_LOGIN_PASSWORD = 1
 STNP_LOGIN_CREATE_ACCOUNT = 2
 
-STNP_LOGIN_CHARSET = [
-    " ",
-    *string.ascii_lowercase,
-    *string.digits,
-    None,
-]
+_LOGIN_FAILED_HEADER = bytes((STNP_LOGIN_MSG_TYPE, STNP_LOGIN_FROM_SERVER_LOGIN_FAILED))
+
+
+#
+# Working structures
+#
 
+_service: LoginServiceProtocol | None = None
 
 #
 # Implementation
@@ -38,49 +55,19 @@ STNP_LOGIN_CHARSET = [
 
 def logged_in_msg(client_id: int, login_type: int) -> bytes:
     """Return a logged in message."""
-    res = bytearray(7)
-    res[0] = STNP_LOGIN_MSG_TYPE
-    res[1] = STNP_LOGIN_FROM_SERVER_LOGGED_IN
-    res[2] = login_type
-    res[3] = client_id & 0x000000FF
-    res[4] = (client_id & 0x0000FF00) >> 8
-    res[5] = (client_id & 0x00FF0000) >> 16
-    res[6] = (client_id & 0xFF000000) >> 24
-    return bytes(res)
+    return bytes(
+        (STNP_LOGIN_MSG_TYPE, STNP_LOGIN_FROM_SERVER_LOGGED_IN, login_type)
+    ) + client_id.to_bytes(4, "little")
 
 
 def login_failed_msg(message: str) -> bytes:
     """Return a login failed message."""
     assert len(message) == MESSAGE_LEN
-
-    res = bytearray(MESSAGE_LEN + 2)
-    res[0] = STNP_LOGIN_MSG_TYPE
-    res[1] = STNP_LOGIN_FROM_SERVER_LOGIN_FAILED
-
-    for i in range(MESSAGE_LEN):
-        res[i + 2] = STNP_LOGIN_CHARSET.index(message[i])
-
-    return res
+    return _LOGIN_FAILED_HEADER + encode_str(message)
 
 
 def parse_login_request(message: bytes) -> dict[str, str] | None:
     """Parse a login request."""
-
-    def parse_stnp_str(offset):
-        """Parse a STNP string."""
-        value = ""
-        for i in range(offset, offset + 16):
-            c = message[i]
-            if c >= len(STNP_LOGIN_CHARSET):
-                logging.warning(
-                    "ill formated login request: invalid character at byte %s", i
-                )
-                return None
-            if c == 0:
-                break
-            value += STNP_LOGIN_CHARSET[c]
-        return value
-
     if (
         len(message) != 34
         or message[0] != STNP_LOGIN_MSG_TYPE
@@ -89,160 +76,208 @@ def parse_login_request(message: bytes) -> dict[str, str] | None:
         logging.warning("ill formated login request")
         return None
 
-    user = parse_stnp_str(2)
-    password = message[18 : 18 + 16].hex()
-    if user is None or password is None:
+    message_view = memoryview(message)
+    user = decode_str(message_view[2 : 2 + 16])
+    if user is None:
+        logging.warning("ill formated login request: invalid character in user name")
         return None
+    password = message_view[18 : 18 + 16].hex()
 
     return {"user": user, "password": password}
 
 
-def check_login_request(message: bytes) -> tuple[bool, dict[str, str] | str]:
-    """Check a login request."""
+def check_login_request(message: bytes) -> tuple[bool, dict[str, str] | bytes]:
+    """Check a login request.
+
+    On failure, the second element is the login failed message to send back.
+    """
     # Parse message
     client_credential = parse_login_request(message)
 
     # Check invalid cases
     if client_credential is None:
-        return (
-            False,
-            "missformed user   "
-            "name or password  "
-            "                  "
-            "                  ",
-        )
+        return (False, LOGIN_FAILED_MISSFORMED_REQUEST)
     if len(client_credential["user"]) < 3:
-        return (
-            False,
-            "user name shall   "
-            "have at least     "
-            "three characters  "
-            "                  ",
-        )
+        return (False, LOGIN_FAILED_USER_NAME_TOO_SHORT)
 
     # Return parsed result
     return (True, client_credential)
 
 
-def handle_msg_login_anonymous(
-    message: bytes,
-    client_addr: tuple[str, int],
-    sock: asyncio.DatagramTransport,
-):
-    """Handle a login anonymous message."""
+#
+# Precomputed messages
+#
+
+LOGIN_FAILED_MISSFORMED_REQUEST = login_failed_msg(
+    "missformed user   "
+    "name or password  "
+    "                  "
+    "                  "
+)
+LOGIN_FAILED_USER_NAME_TOO_SHORT = login_failed_msg(
+    "user name shall   "
+    "have at least     "
+    "three characters  "
+    "                  "
+)
+LOGIN_FAILED_INVALID_CREDENTIALS = login_failed_msg(
+    "invalid user name "
+    "or password       "
+    "                  "
+    "                  "
+)
+LOGIN_FAILED_USER_NAME_EXISTS = login_failed_msg(
+    "this user name    "
+    "already exists    "
+    "                  "
+    "                  "
+)
+LOGIN_FAILED_INTERNAL_ERROR = login_failed_msg(
+    "internal error    "
+    "when creating your"
+    "account           "
+    "                  "
+)
+LOGIN_FAILED_INVALID_MESSAGE = login_failed_msg(
+    "invalid login     "
+    "message           "
+    "                  "
+    "                  "
+)
+
+
+def handle_msg_login_anonymous(message: bytes) -> bytes:
+    """Handle a login anonymous message, return the response."""
     # Log the user with a fresh anonymous ID
     client_id = logindb.get_anonymous_id()
-    sock.sendto(logged_in_msg(client_id, STNP_LOGIN_ANONYMOUS), client_addr)
+    return logged_in_msg(client_id, STNP_LOGIN_ANONYMOUS)
 
 
-def handle_msg_login_password(
-    message: bytes,
-    client_addr: tuple[str, int],
-    sock: asyncio.DatagramTransport,
-):
-    """Handle a login password message."""
+def handle_msg_login_password(message: bytes) -> bytes:
+    """Handle a login password message, return the response."""
     # Parse message
     parsed_message = check_login_request(message)
     if not parsed_message[0]:
-        assert isinstance(parsed_message[1], str)
-        sock.sendto(login_failed_msg(parsed_message[1]), client_addr)
-        return
+        assert isinstance(parsed_message[1], bytes)
+        return parsed_message[1]
     client_credential = parsed_message[1]
 
     # Get client info from DB (register the user if needed)
     assert isinstance(client_credential, dict)
-    client_info = logindb.get_user_info(client_credential["user"])
-    if client_info is None:
+    client_info, registered = logindb.get_or_register_user(
+        client_credential["user"], client_credential["password"]
+    )
+    if registered:
         logging.info('new user: "%s"', client_credential["user"])
-        logindb.register_user(client_credential["user"], client_credential["password"])
-        client_info = logindb.get_user_info(client_credential["user"])
 
     # Send response
-    if (
-        client_info is not None
-        and client_info["password"] == client_credential["password"]
-    ):
+    if client_info["password"] == client_credential["password"]:
         # Password match, send the ID
-        sock.sendto(
-            logged_in_msg(client_info["user_id"], STNP_LOGIN_PASSWORD), client_addr
-        )
-    else:
-        # Password mismatch, send access denied
-        sock.sendto(
-            login_failed_msg(
-                "invalid user name "
-                "or password       "
-                "                  "
-                "                  "
-            ),
-            client_addr,
-        )
+        return logged_in_msg(client_info["user_id"], STNP_LOGIN_PASSWORD)
 
+    # Password mismatch, send access denied
+    return LOGIN_FAILED_INVALID_CREDENTIALS
 
-def handle_msg_create_account(
-    message: bytes,
-    client_addr: tuple[str, int],
-    sock: asyncio.DatagramTransport,
-):
-    """Handle a create account message."""
+
+def handle_msg_create_account(message: bytes) -> bytes:
+    """Handle a create account message, return the response."""
     # Parse message
     parsed_message = check_login_request(message)
     if not parsed_message[0]:
-        assert isinstance(parsed_message[1], str)
-        sock.sendto(login_failed_msg(parsed_message[1]), client_addr)
-        return
+        assert isinstance(parsed_message[1], bytes)
+        return parsed_message[1]
     client_credential = parsed_message[1]
 
-    # Check that client does not already exists
+    # Register the user, unless it already exists
     assert isinstance(client_credential, dict)
-    client_info = logindb.get_user_info(client_credential["user"])
-    if client_info is not None:
-        sock.sendto(
-            login_failed_msg(
-                "this user name    "
-                "already exists    "
-                "                  "
-                "                  "
-            ),
-            client_addr,
-        )
-        return
-
-    # Register the user
+    client_info, registered = logindb.get_or_register_user(
+        client_credential["user"], client_credential["password"]
+    )
+    if not registered:
+        return LOGIN_FAILED_USER_NAME_EXISTS
     logging.info('new user: "%s"', client_credential["user"])
-    logindb.register_user(client_credential["user"], client_credential["password"])
-    client_info = logindb.get_user_info(client_credential["user"])
 
     # Sanity check
-    if client_info is None or client_info["password"] != client_credential["password"]:
+    if client_info["password"] != client_credential["password"]:
         logging.error(
             "failed to create '%s' '%s'",
             client_credential["user"],
             client_credential["password"],
         )
-        sock.sendto(
-            login_failed_msg(
-                "internal error    "
-                "when creating your"
-                "account           "
-                "                  "
-            ),
-            client_addr,
-        )
+        return LOGIN_FAILED_INTERNAL_ERROR
+
+    return logged_in_msg(client_info["user_id"], STNP_LOGIN_CREATE_ACCOUNT)
+
+
+MESSAGE_HANDLERS = {
+    STNP_LOGIN_ANONYMOUS: handle_msg_login_anonymous,
+    STNP_LOGIN_PASSWORD: handle_msg_login_password,
+    STNP_LOGIN_CREATE_ACCOUNT: handle_msg_create_account,
+}
+
+# Name of the histogram of successfully handled messages, by login type
+MESSAGE_METRICS = {
+    STNP_LOGIN_ANONYMOUS: "anonymous",
+    STNP_LOGIN_PASSWORD: "password",
+    STNP_LOGIN_CREATE_ACCOUNT: "create_account",
+}
+
+
+def _run_handler(
+    handler: Callable[[bytes], bytes],
+    message: bytes,
+    queued_ns: int,
+) -> bytes | None:
+    """Run a message handler in a worker thread, return None on failure."""
+    begin_ns = time.perf_counter_ns()
+    metrics.record("queue_wait", begin_ns - queued_ns)
+    try:
+        response = handler(message)
+    except Exception:
+        metrics.record("exception", time.perf_counter_ns() - begin_ns)
+        logging.exception("error when handling message")
+        return None
+
+    if response[1] == STNP_LOGIN_FROM_SERVER_LOGIN_FAILED:
+        metrics.record("rejected", time.perf_counter_ns() - begin_ns)
     else:
-        sock.sendto(
-            logged_in_msg(client_info["user_id"], STNP_LOGIN_CREATE_ACCOUNT),
-            client_addr,
-        )
+        metrics.record(MESSAGE_METRICS[message[1]], time.perf_counter_ns() - begin_ns)
+    return response
 
 
 class LoginServiceProtocol(asyncio.DatagramProtocol):
-    """Login service protocol."""
+    """Login service protocol.
+
+    Login messages are handled by a pool of worker threads, so that database
+    accesses never block the event loop. At most ``queue_size`` messages can be
+    pending, messages received while the queue is full are dropped.
+
+    Messages refused by admission control are dropped before being queued.
+    Retransmitted messages are answered from the response cache.
+    """
+
+    def __init__(
+        self,
+        executor: Executor,
+        queue_size: int = QUEUE_SIZE,
+        admission: AdmissionControl | None = None,
+        response_cache: ResponseCache | None = None,
+    ) -> None:
+        """Initialize the protocol."""
+        self.executor = executor
+        self.admission = admission
+        self.response_cache = response_cache
+        self.queue_size = queue_size
+        self.queue_depth = 0
+        self.nb_shed = 0
 
     def connection_made(self, transport: asyncio.BaseTransport) -> None:
         """Handle a new connection."""
-        assert isinstance(transport, asyncio.DatagramTransport)
-        self.transport = transport
+        # uvloop's transports do not derive from asyncio's ones, only provide
+        # the same interface
+        assert hasattr(transport, "sendto")
+        self.transport = cast(asyncio.DatagramTransport, transport)
+        self.loop = asyncio.get_running_loop()
 
     def datagram_received(self, message: bytes, client_addr: tuple[str, int]) -> None:
         """Handle a datagram."""
@@ -252,37 +287,167 @@ class LoginServiceProtocol(asyncio.DatagramProtocol):
             client_addr[1],
             message,
         )
-        message_handlers = {
-            STNP_LOGIN_ANONYMOUS: handle_msg_login_anonymous,
-            STNP_LOGIN_PASSWORD: handle_msg_login_password,
-            STNP_LOGIN_CREATE_ACCOUNT: handle_msg_create_account,
-        }
         if len(message) >= 2 and message[0] == STNP_LOGIN_MSG_TYPE:
             logging.debug("login message")
-            if message[1] in message_handlers:
-                try:
-                    message_handlers[message[1]](message, client_addr, self.transport)
-                except Exception:
-                    logging.exception("error when handling message")
-            else:
+            handler = MESSAGE_HANDLERS.get(message[1])
+            if handler is None:
                 logging.debug("unknown login method")
-                self.transport.sendto(
-                    login_failed_msg(
-                        "invalid login     "
-                        "message           "
-                        "                  "
-                        "                  "
-                    ),
-                    client_addr,
-                )
-
-
-async def serve(listen_port: int) -> asyncio.DatagramTransport:
-    """Serve login requests."""
+                self.transport.sendto(LOGIN_FAILED_INVALID_MESSAGE, client_addr)
+                return
+
+            if self.admission is not None and not self.admission.admit(
+                client_addr[0]
+            ):
+                logging.debug("rate limited, dropped message")
+                return
+
+            cache_key = (client_addr, message)
+            if self.response_cache is not None:
+                cached_response = self.response_cache.lookup(cache_key)
+                if cached_response is not None:
+                    logging.debug("retransmitted message")
+                    if cached_response:
+                        self.transport.sendto(cached_response, client_addr)
+                    return
+
+            if self.queue_depth >= self.queue_size:
+                logging.debug("queue full, dropped message")
+                self.nb_shed += 1
+                if self.response_cache is not None:
+                    self.response_cache.abort(cache_key)
+                return
+
+            self.queue_depth += 1
+            queued_ns = time.perf_counter_ns()
+            response = self.loop.run_in_executor(
+                self.executor, _run_handler, handler, message, queued_ns
+            )
+            response.add_done_callback(
+                functools.partial(self._reply, cache_key, queued_ns)
+            )
+
+    def _reply(
+        self,
+        cache_key: tuple[tuple[str, int], bytes],
+        queued_ns: int,
+        response: asyncio.Future,
+    ) -> None:
+        """Send the response of a handled message."""
+        self.queue_depth -= 1
+        client_addr = cache_key[0]
+        if response.cancelled() or response.result() is None:
+            if self.response_cache is not None:
+                self.response_cache.abort(cache_key)
+            return
+        if self.response_cache is not None:
+            self.response_cache.store(cache_key, response.result())
+        if not self.transport.is_closing():
+            self.transport.sendto(response.result(), client_addr)
+        metrics.record("reply", time.perf_counter_ns() - queued_ns)
+
+    def get_stats(self) -> dict:
+        """Get the state of the work queue, admission control and cache."""
+        stats = {
+            "queue_depth": self.queue_depth,
+            "queue_size": self.queue_size,
+            "shed": self.nb_shed,
+        }
+        if self.admission is not None:
+            stats["admission"] = self.admission.get_stats()
+        if self.response_cache is not None:
+            stats["response_cache"] = self.response_cache.get_stats()
+        return stats
+
+
+def get_stats() -> dict | None:
+    """Get the state of the running login service, None if not running."""
+    global _service
+    if _service is None:
+        return None
+    return _service.get_stats()
+
+
+async def serve(
+    listen_port: int,
+    workers: int = WORKERS,
+    queue_size: int = QUEUE_SIZE,
+    reuse_port: bool = False,
+    admission: AdmissionControl | None = None,
+    response_cache: ResponseCache | None = None,
+    executor: Executor | None = None,
+) -> asyncio.DatagramTransport:
+    """Serve login requests.
+
+    With ``reuse_port``, other processes can serve the same port. Messages are
+    handled by ``executor``, a new pool of ``workers`` threads by default.
+    """
+    global _service
     logging.info("starting login service on port %s", listen_port)
     loop = asyncio.get_running_loop()
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="login")
     transport, protocol = await loop.create_datagram_endpoint(
-        LoginServiceProtocol, local_addr=("0.0.0.0", listen_port)
+        lambda: LoginServiceProtocol(
+            executor, queue_size, admission, response_cache
+        ),
+        local_addr=("0.0.0.0", listen_port),
+        reuse_port=reuse_port,
     )
-    assert isinstance(transport, asyncio.DatagramTransport)
-    return transport
+    assert isinstance(protocol, LoginServiceProtocol)
+    _service = protocol
+    return protocol.transport
+
+
+def is_loop_available(loop: str) -> bool:
+    """Check if an event loop implementation can be used."""
+    return loop != "uvloop" or importlib.util.find_spec("uvloop") is not None
+
+
+def new_event_loop(loop: str = LOOP) -> asyncio.AbstractEventLoop:
+    """Create an event loop of the given implementation, see ``LOOPS``."""
+    if loop not in LOOPS:
+        raise Exception(f'unknown event loop "{loop}"')
+    if loop != "asyncio" and is_loop_available("uvloop"):
+        import uvloop
+
+        return uvloop.new_event_loop()
+    if loop == "uvloop":
+        raise Exception("uvloop is not installed")
+    return asyncio.new_event_loop()
+
+
+def run_process(
+    listen_port: int,
+    workers: int = WORKERS,
+    queue_size: int = QUEUE_SIZE,
+    admission: AdmissionControl | None = None,
+    response_cache: ResponseCache | None = None,
+    loop: str = LOOP,
+) -> None:
+    """Serve login requests from a secondary process, until interrupted.
+
+    The port is shared with other processes, the caller is responsible to load
+    the database in shared mode.
+    """
+
+    async def serve_forever():
+        transport = await serve(
+            listen_port,
+            workers,
+            queue_size,
+            reuse_port=True,
+            admission=admission,
+            response_cache=response_cache,
+        )
+        try:
+            await asyncio.Event().wait()
+        finally:
+            transport.close()
+
+    event_loop = new_event_loop(loop)
+    asyncio.set_event_loop(event_loop)
+    try:
+        with contextlib.suppress(KeyboardInterrupt):
+            event_loop.run_until_complete(serve_forever())
+    finally:
+        event_loop.close()
@@ -0,0 +1,213 @@
+"""Compact representation of registered users, and its binary snapshot format.
+
+Registered users are stored as ``UserRecord`` objects, holding the password
+digest as raw bytes instead of an hex string.
+
+Binary snapshots are made of a header followed by columns, so that loading
+mostly consists of bulk conversions::
+
+    magic          8 bytes, "STBLOGIN"
+    version        u32
+    nb_users       u32
+    next_anon_id   u64
+    next_reg_id    u64
+    names_len      u64
+    names          names_len bytes, UTF-8 user names separated by a NUL byte
+    user_ids       nb_users * u32
+    passwords      nb_users * 16 bytes, raw password digests
+    extra_len      u64
+    extra          extra_len bytes, JSON object of passwords which are not
+                   digests, by user name
+
+Integers are little endian.
+"""
+
+from __future__ import annotations
+
+import array
+import gc
+import json
+import struct
+import sys
+from pathlib import Path
+from typing import Iterable
+
+SNAPSHOT_MAGIC = b"STBLOGIN"
+SNAPSHOT_VERSION = 1
+
+PASSWORD_DIGEST_LEN = 16
+
+_HEADER = struct.Struct("<8sIIQQQ")
+_EXTRA_LEN = struct.Struct("<Q")
+
+
+class UserRecord:
+    """Registered user's info."""
+
+    __slots__ = ("password", "user_id")
+
+    def __init__(self, password: bytes | str, user_id: int) -> None:
+        """Create a record, see ``pack_password`` for the password format."""
+        self.password = password
+        self.user_id = user_id
+
+    def to_dict(self) -> dict:
+        """Get user info, as stored in JSON databases."""
+        return {"password": unpack_password(self.password), "user_id": self.user_id}
+
+
+def pack_password(password: str) -> bytes | str:
+    """Get the compact form of a password.
+
+    Hex digests are stored as bytes, anything else is kept as is.
+    """
+    if len(password) == 2 * PASSWORD_DIGEST_LEN:
+        try:
+            digest = bytes.fromhex(password)
+        except ValueError:
+            return password
+        if digest.hex() == password:
+            return digest
+    return password
+
+
+def unpack_password(password: bytes | str) -> str:
+    """Get the original form of a compact password."""
+    if isinstance(password, bytes):
+        return password.hex()
+    return password
+
+
+def from_json(json_db: dict) -> dict:
+    """Convert a database loaded from JSON to its compact form."""
+    return {
+        **json_db,
+        "registered_logins": {
+            user_name: UserRecord(
+                pack_password(user_info["password"]), user_info["user_id"]
+            )
+            for user_name, user_info in json_db["registered_logins"].items()
+        },
+    }
+
+
+def to_json(user_db: dict) -> dict:
+    """Convert a database to a JSON serializable form."""
+    return {
+        **user_db,
+        "registered_logins": {
+            user_name: user_record.to_dict()
+            for user_name, user_record in user_db["registered_logins"].items()
+        },
+    }
+
+
+def is_snapshot(path: Path) -> bool:
+    """Check if a file is a binary snapshot."""
+    with path.open("rb") as f:
+        return f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+def write_snapshot(
+    path: Path, user_db: dict, user_names: Iterable[str] | None = None
+) -> None:
+    """Write a binary snapshot of the database.
+
+    Users are written in the order of ``user_names``, which must list all of
+    them, or in the order of the database by default.
+    """
+    users = user_db["registered_logins"]
+    if user_names is None:
+        user_names = users
+    records = [users[user_name] for user_name in user_names]
+    assert len(records) == len(users)
+    names = "\0".join(user_names).encode()
+    user_ids = array.array("I", (record.user_id for record in records))
+    assert user_ids.itemsize == 4
+    if sys.byteorder == "big":
+        # Arrays are in native byte order, the snapshot is little endian
+        user_ids.byteswap()
+    passwords = b"".join(
+        record.password if isinstance(record.password, bytes) else bytes(16)
+        for record in records
+    )
+    extra = json.dumps(
+        {
+            user_name: record.password
+            for user_name, record in users.items()
+            if not isinstance(record.password, bytes)
+        }
+    ).encode()
+
+    with path.open("wb") as f:
+        f.write(
+            _HEADER.pack(
+                SNAPSHOT_MAGIC,
+                SNAPSHOT_VERSION,
+                len(users),
+                user_db["next_anonymous_id"],
+                user_db["next_registered_id"],
+                len(names),
+            )
+        )
+        f.write(names)
+        f.write(user_ids.tobytes())
+        f.write(passwords)
+        f.write(_EXTRA_LEN.pack(len(extra)))
+        f.write(extra)
+
+
+def read_snapshot(path: Path) -> dict:
+    """Read a binary snapshot of the database."""
+    data = path.read_bytes()
+    view = memoryview(data)
+    (
+        magic,
+        version,
+        nb_users,
+        next_anonymous_id,
+        next_registered_id,
+        names_len,
+    ) = _HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise Exception(f'unsupported login database snapshot "{path}"')
+
+    offset = _HEADER.size
+    names = data[offset : offset + names_len].decode().split("\0") if nb_users else []
+    offset += names_len
+
+    user_ids = array.array("I")
+    assert user_ids.itemsize == 4
+    user_ids.frombytes(view[offset : offset + 4 * nb_users])
+    if sys.byteorder == "big":
+        # Arrays are in native byte order, the snapshot is little endian
+        user_ids.byteswap()
+    offset += 4 * nb_users
+
+    passwords_end = offset + PASSWORD_DIGEST_LEN * nb_users
+    passwords = [
+        data[password_offset : password_offset + PASSWORD_DIGEST_LEN]
+        for password_offset in range(offset, passwords_end, PASSWORD_DIGEST_LEN)
+    ]
+    offset = passwords_end
+
+    (extra_len,) = _EXTRA_LEN.unpack_from(data, offset)
+    offset += _EXTRA_LEN.size
+    extra = json.loads(data[offset : offset + extra_len])
+
+    # Only acyclic objects are created, collecting garbage would be a waste
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        registered_logins = dict(zip(names, map(UserRecord, passwords, user_ids)))
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    for user_name, password in extra.items():
+        registered_logins[user_name].password = password
+
+    return {
+        "registered_logins": registered_logins,
+        "next_anonymous_id": next_anonymous_id,
+        "next_registered_id": next_registered_id,
+    }
@@ -19,6 +19,9 @@ LOG_LEVEL = "info"
 CLIENTS_WHITE_LIST = "127.0.0.1"
 LOGIN_SERVER_ADDR = "127.0.0.1"
 LOGIN_SERVER_PORT = 8124
+COMMIT_DELAY = rankingdb.COMMIT_DELAY
+COMMIT_BATCH_SIZE = rankingdb.COMMIT_BATCH_SIZE
+DEDUP_WINDOW = rankingdb.DEDUP_WINDOW
 
 
 @click.command()
@@ -52,6 +55,24 @@ LOGIN_SERVER_PORT = 8124
     default=LOGIN_SERVER_PORT,
     help="port of the login server's REST API",
 )
+@click.option(
+    "--commit-delay",
+    type=click.FloatRange(min=0),
+    default=COMMIT_DELAY,
+    help="seconds of changes grouped in one write of the db file, 0 for no grouping",
+)
+@click.option(
+    "--commit-batch-size",
+    type=click.IntRange(min=1),
+    default=COMMIT_BATCH_SIZE,
+    help="number of grouped changes which triggers writing the db file",
+)
+@click.option(
+    "--dedup-window",
+    type=click.IntRange(min=0),
+    default=DEDUP_WINDOW,
+    help="seconds during which a pushed game is not applied again",
+)
 @click.option(
     "--log-file",
     type=Path,
@@ -70,6 +91,9 @@ def main(
     white_list: str,
     login_srv_addr: str,
     login_srv_port: int,
+    commit_delay: float,
+    commit_batch_size: int,
+    dedup_window: int,
     log_file: Path,
     log_level: str,
 ):
@@ -92,7 +116,9 @@ def main(
     clients_white_list = white_list.split(",")
 
     # Initialize ranking database
-    rankingdb.load(db_file, login_server)
+    rankingdb.load(
+        db_file, login_server, commit_delay, commit_batch_size, dedup_window
+    )
 
     # Start serving REST requests
     restservice.serve(rest_port, whitelist=clients_white_list)
@@ -0,0 +1,194 @@
+"""Append-only journal of the games applied to the ranking database.
+
+The journal is a header followed by fixed size little endian records::
+
+    header         8 bytes, "STBGAME1"
+    records        one per game:
+        game       16 bytes, game UUID, zeros if unknown
+        begin      u32, seconds since epoch, zero if unknown
+        end        u32, seconds since epoch, zero if unknown
+        user_a     u32, user ID of player A
+        user_b     u32, user ID of player B
+        flags      u8, see ``FLAG_*``
+
+Records are only appended. A record left incomplete by a crash is dropped when
+the journal is opened again. The ranking database stores the number of records
+it includes, records after it are replayed on load.
+"""
+
+from __future__ import annotations
+
+import datetime
+import logging
+import os
+import struct
+import uuid
+from pathlib import Path
+from typing import Iterator
+
+JOURNAL_MAGIC = b"STBGAME1"
+
+RECORD = struct.Struct("<16sIIIIB")
+
+# Largest user ID or date which fits in a record
+MAX_FIELD_VALUE = 0xFFFFFFFF
+
+FLAG_A_RANKED = 0x01
+FLAG_B_RANKED = 0x02
+FLAG_B_WINS = 0x04
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Parameters' default
+CHUNK_RECORDS = 65536
+
+
+def parse_date(date) -> int:
+    """Convert a game date to seconds since epoch, zero if invalid."""
+    try:
+        return int(
+            datetime.datetime.strptime(date, DATE_FORMAT)
+            .replace(tzinfo=datetime.timezone.utc)
+            .timestamp()
+        )
+    except (TypeError, ValueError):
+        return 0
+
+
+def encode_game(game_info: dict, user_a: int, user_b: int) -> bytes:
+    """Get the journal record of a game, played by the given user IDs."""
+    try:
+        game_uuid = uuid.UUID(str(game_info.get("game"))).bytes
+    except ValueError:
+        game_uuid = bytes(16)
+    flags = (
+        (FLAG_A_RANKED if game_info["player_a_ranked"] == 1 else 0)
+        | (FLAG_B_RANKED if game_info["player_b_ranked"] == 1 else 0)
+        | (FLAG_B_WINS if game_info["winner"] != 0 else 0)
+    )
+    return RECORD.pack(
+        game_uuid,
+        parse_date(game_info["begin"]),
+        parse_date(game_info["end"]),
+        user_a,
+        user_b,
+        flags,
+    )
+
+
+def _format_date(timestamp: int) -> str | None:
+    """Convert seconds since epoch to a game date, None if zero."""
+    if timestamp == 0:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime(
+        DATE_FORMAT
+    )
+
+
+def decode_game(record: bytes) -> tuple[dict, int, int]:
+    """Get the game info of a journal record, and the user IDs of its players."""
+    game_uuid, begin, end, user_a, user_b, flags = RECORD.unpack(record)
+    game_info = {
+        "game": str(uuid.UUID(bytes=game_uuid)) if any(game_uuid) else None,
+        "begin": _format_date(begin),
+        "end": _format_date(end),
+        "client_a": user_a,
+        "client_b": user_b,
+        "player_a_ranked": 1 if flags & FLAG_A_RANKED else 0,
+        "player_b_ranked": 1 if flags & FLAG_B_RANKED else 0,
+        "winner": 1 if flags & FLAG_B_WINS else 0,
+    }
+    return (game_info, user_a, user_b)
+
+
+class GameJournal:
+    """Journal opened for appending."""
+
+    def __init__(self, path: Path) -> None:
+        """Open the journal, creating it if needed."""
+        self.path = path
+        self._file = path.open("a+b")
+        size = self._file.seek(0, os.SEEK_END)
+        self.nb_records = 0
+        if size == 0:
+            self._file.write(JOURNAL_MAGIC)
+            self._file.flush()
+            return
+
+        self._file.seek(0)
+        if self._file.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+            self._file.close()
+            raise Exception(f'invalid game journal "{path}"')
+        torn_len = (size - len(JOURNAL_MAGIC)) % RECORD.size
+        if torn_len != 0:
+            logging.warning("dropped incomplete game journal record: %s", path)
+            self._file.truncate(size - torn_len)
+        self.nb_records = (size - torn_len - len(JOURNAL_MAGIC)) // RECORD.size
+
+    def append(self, records: list[bytes]) -> None:
+        """Append encoded games to the journal."""
+        self._file.write(b"".join(records))
+        self._file.flush()
+        self.nb_records += len(records)
+
+    def close(self) -> None:
+        """Close the journal."""
+        self._file.close()
+
+
+def read_chunks(
+    path: Path, chunk_records: int = CHUNK_RECORDS, first_record: int = 0
+) -> Iterator[bytes]:
+    """Read the records of a journal, by chunks of whole records.
+
+    Records before the ``first_record``-th are skipped.
+    """
+    with path.open("rb") as f:
+        if f.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+            raise Exception(f'invalid game journal "{path}"')
+        f.seek(first_record * RECORD.size, os.SEEK_CUR)
+        while True:
+            chunk = f.read(chunk_records * RECORD.size)
+            chunk = chunk[: len(chunk) - len(chunk) % RECORD.size]
+            if not chunk:
+                return
+            yield chunk
+
+
+def read_recent_games(
+    path: Path, since: int, chunk_records: int = CHUNK_RECORDS
+) -> list[tuple[bytes, int]]:
+    """Get (UUID, begin) of the last games begun at or after ``since``.
+
+    The journal is read backwards, until a chunk of games all begun before
+    ``since``. Games without UUID are skipped, games are in journal order.
+    """
+    chunks = []
+    with path.open("rb") as f:
+        if f.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+            raise Exception(f'invalid game journal "{path}"')
+        size = f.seek(0, os.SEEK_END)
+        end = size - (size - len(JOURNAL_MAGIC)) % RECORD.size
+        chunk_size = chunk_records * RECORD.size
+        while end > len(JOURNAL_MAGIC):
+            begin = max(len(JOURNAL_MAGIC), end - chunk_size)
+            f.seek(begin)
+            games = [
+                (game, game_begin)
+                for game, game_begin, _, _, _, _ in RECORD.iter_unpack(
+                    f.read(end - begin)
+                )
+                if game_begin >= since
+            ]
+            if not games:
+                break
+            chunks.append(games)
+            end = begin
+
+    no_uuid = bytes(16)
+    return [
+        (game, game_begin)
+        for games in reversed(chunks)
+        for game, game_begin in games
+        if game != no_uuid
+    ]
@@ -0,0 +1,59 @@
+"""Sorted ladder of players, updated incrementally."""
+
+from __future__ import annotations
+
+from typing import Iterable
+
+from sortedcontainers import SortedList
+
+
+class Ladder:
+    """Players sorted by score then name, best first.
+
+    Scores are updated in O(log n), a player's rank is read in O(log n) and
+    a page of the ladder in O(log n + page size).
+    """
+
+    def __init__(self, entries: Iterable[tuple[int, str, str]] = ()) -> None:
+        """Initialize a ladder from (score, name, user ID) entries."""
+        # (score, name, user ID) in ascending order
+        self._entries = SortedList(entries)
+        self._keys: dict[str, tuple[int, str, str]] = {
+            key[2]: key for key in self._entries
+        }
+
+    def __len__(self) -> int:
+        """Get the number of players."""
+        return len(self._entries)
+
+    def set_score(self, user_id: str, name: str, score: int) -> None:
+        """Set the score of a player, adding it if needed."""
+        key = self._keys.get(user_id)
+        if key is not None:
+            self._entries.remove(key)
+        key = (score, name, user_id)
+        self._keys[user_id] = key
+        self._entries.add(key)
+
+    def remove(self, user_id: str) -> None:
+        """Remove a player, if present."""
+        key = self._keys.pop(user_id, None)
+        if key is not None:
+            self._entries.remove(key)
+
+    def page(self, offset: int = 0, limit: int | None = None) -> list[tuple[int, str]]:
+        """Get (score, name) of ``limit`` players from the ``offset``-th best."""
+        end = len(self._entries) - offset
+        begin = 0 if limit is None else max(0, end - limit)
+        return [
+            (score, name)
+            for score, name, _ in self._entries.islice(begin, max(0, end), reverse=True)
+        ]
+
+    def get(self, user_id: str) -> tuple[int, int, str] | None:
+        """Get (rank, score, name) of a player, rank 1 for the best."""
+        key = self._keys.get(user_id)
+        if key is None:
+            return None
+        score, name, _ = key
+        return (len(self._entries) - self._entries.index(key), score, name)
@@ -1,25 +1,147 @@
-"""Ranking database management for Super Tilt Bro."""
+"""Ranking database management for Super Tilt Bro.
+
+Named users are indexed in a sorted list of (ranked MMR, name, user ID), updated
+when their MMR changes, so that the ladder and ranks are read without sorting.
+
+Users only enter the ladder once their name is known. Names are resolved in
+the background by ``resolve_names``, reading the ladder never waits for the
+login server. User IDs unknown to the login server are not asked again before
+``UNKNOWN_NAME_TTL`` seconds.
+
+Changes are not written to the database file by the push itself but in the
+background: ``commit_changes`` writes them from the default executor, at most
+``commit_delay`` seconds after the first one, or as soon as
+``commit_batch_size`` changes are pending. ``flush`` writes pending changes
+immediately, and must be awaited on shutdown. Without ``commit_changes``
+running, each change is written immediately.
+
+Games applied to a database stored in a file are first appended to a games
+journal, see :mod:`gamejournal`, from which :mod:`rebuild` recomputes MMRs. The
+database file stores the number of journaled games it includes, games
+journaled after them, pushed but not yet written when the server stopped, are
+replayed on load.
+
+Dated games also update time-windowed ladders:
+
+- seasons, each of ``SEASON_MONTHS`` months, with their own MMRs starting from
+  the initial MMR, updated by the games which began during the season,
+- rolling windows of the last days, ranking players by ranked MMR won during
+  the window. Ranked MMR changes are summed per day and per player, each
+  window keeps the total of the days it covers, days leaving a window are
+  subtracted from it.
+
+Pushes are idempotent: UUIDs of the games pushed during the last
+``dedup_window`` seconds are remembered, a game whose UUID is among them is
+acknowledged but not applied again. Games without UUID are always applied.
+The UUIDs are not stored in the database file, they are recovered from the tail
+of the games journal on load, once its games are replayed, dated by the
+beginning of their game. A game is only remembered once applied.
+
+Changes are applied by a single writer, ``run_writer``, one at a time: ``push``
+and the name resolution queue their changes to it and wait for the result.
+Changes are applied on the event loop without yielding to it, and readers
+read the ladders from the event loop without yielding either, so reads never
+see a change half applied.
+"""
 
 from __future__ import annotations
 
+import asyncio
 import copy
+import datetime
 import json
 import logging
+import time
+import uuid
 from pathlib import Path
+from typing import Iterable
 
 import requests
 
+from . import gamejournal
+from .ladder import Ladder
+
+# Parameters' default
+NAME_RESOLUTION_INTERVAL = 2.0
+UNKNOWN_NAME_TTL = 600.0
+COMMIT_DELAY = 0.0
+COMMIT_BATCH_SIZE = 1000
+WINDOWS_REFRESH_INTERVAL = 60.0
+DEDUP_WINDOW = 7 * 24 * 3600
+
+INITIAL_MMR = 1000
+
+# Length of a season, in months, must divide a year
+SEASON_MONTHS = 3
+
+# Rolling windows, in days
+ROLLING_WINDOWS = [7, 30]
+
+# Maximum number of user IDs per name resolution request
+NAME_BATCH_SIZE = 500
+
+# Delay after which requests to the login server are aborted, in seconds
+LOGIN_SERVER_TIMEOUT = 10.0
+
+# Minimum delay before writing the database file again after a failure, in seconds
+COMMIT_RETRY_DELAY = 1.0
+
 #
 # Working structures
 #
 
 _db_file: Path | None = None
+_games_journal: gamejournal.GameJournal | None = None
 _login_server = None
+_http: requests.Session | None = None
+
+# Group commit, changes not yet written and the write in progress
+_commit_delay = COMMIT_DELAY
+_commit_batch_size = COMMIT_BATCH_SIZE
+_commit_event: asyncio.Event | None = None
+_commit_lock: asyncio.Lock | None = None
+_pending_changes = 0
+
+# Changes waiting for the writer, (operation, arguments, result future)
+_write_queue: asyncio.Queue | None = None
+
+# Time during which pushed games are remembered, in seconds
+_dedup_window = DEDUP_WINDOW
+
+# Game UUID to push time in seconds since epoch, in push order
+_pushed_games: dict[bytes, int] = {}
+
+# User ID to time at which to ask again the name of a user unknown to the
+# login server, as returned by time.monotonic()
+_unknown_users: dict[str, float] = {}
 
 ranking_db = {
     "users": {},
+    # Season ID to user ID to season's MMRs
+    "seasons": {},
+    # Day (ISO 8601) to user ID to [ranked MMR change, number of ranked games]
+    "daily_deltas": {},
+    # Number of games journal records included
+    "journaled_games": 0,
 }
 
+# Elo changes, by (opponent's mmr advantage, score)
+_elo_deltas: dict[tuple[int, int], float] = {}
+
+# Ladder index, ranked MMR of named users
+_ladder = Ladder()
+_ladder_version = 0
+_unnamed_users: set[str] = set()
+
+# Time-windowed ladders, of named users
+_season_ladders: dict[str, Ladder] = {}
+_window_ladders: dict[int, Ladder] = {}
+
+# Rolling windows' totals, user ID to [ranked MMR change, number of ranked games],
+# and first day covered, as a proleptic Gregorian ordinal
+_window_totals: dict[int, dict[str, list[int]]] = {}
+_window_first_day: dict[int, int] = {}
+
 #
 # Utilities
 #
@@ -41,56 +163,365 @@ def _elo(player_mmr, opponent_mmr, score):
     >>> _elo(1200, 1000, 0)
     1176
     """
-    K = 32  # Maximum change in score
-    SPREAD = 400  # A difference of SPREAD/2 MMR points, means the highest ranked player should have ~75% winrate
-    expected_score = 1 / (1 + 10 ** ((opponent_mmr - player_mmr) / SPREAD))
-    new_mmr = player_mmr + K * (score - expected_score)
+    new_mmr = player_mmr + elo_delta(opponent_mmr - player_mmr, score)
     return max(0, round(new_mmr))
 
 
+def elo_delta(mmr_difference, score):
+    """Compute the unrounded change of mmr, given the opponent's mmr advantage.
+
+    Only depends on the mmr difference and the score, results are cached. Also
+    used by :mod:`rebuild` to replay games.
+    """
+    delta = _elo_deltas.get((mmr_difference, score))
+    if delta is None:
+        K = 32  # Maximum change in score
+        SPREAD = 400  # A difference of SPREAD/2 MMR points, means the highest ranked player should have ~75% winrate
+        expected_score = 1 / (1 + 10 ** (mmr_difference / SPREAD))
+        delta = K * (score - expected_score)
+        _elo_deltas[(mmr_difference, score)] = delta
+    return delta
+
+
 #
 # Internal utilities
 #
 
 
+def _games_journal_path(db_file: Path) -> Path:
+    """Get the path of the games journal associated to a database file."""
+    return Path(f"{db_file}.games")
+
+
+def _write_db(db_file: Path, serialized_db: str) -> None:
+    """Replace the database file by the given serialized database."""
+    tmp_db_path = Path(f"{db_file}.tmp")
+    with tmp_db_path.open("w") as tmp_db:
+        tmp_db.write(serialized_db)
+    tmp_db_path.replace(db_file)
+
+
+def _serialize_db() -> str:
+    """Serialize the database, with the number of games journaled so far."""
+    global _games_journal, ranking_db
+    if _games_journal is not None:
+        ranking_db["journaled_games"] = _games_journal.nb_records
+    return json.dumps(ranking_db)
+
+
 def _sync_db() -> None:
     """Synchronize the database with the file."""
-    global _db_file, ranking_db
+    global _db_file, _pending_changes
     if _db_file is not None:
-        tmp_db_path = Path(f"{_db_file}.tmp")
-        with tmp_db_path.open("w") as tmp_db:
-            json.dump(ranking_db, tmp_db)
-        tmp_db_path.replace(_db_file)
+        _pending_changes = 0
+        _write_db(_db_file, _serialize_db())
 
 
-def _get_user_id(timepoint, connection_id):
-    """Get the user ID associated with the given connection ID."""
-    # TODO should ask the login server for the association timepoint+connection_id to user_id
-    #     For now user_id == connection_id, let's assume it
-    #     just convert it to hex string type (to be a valid json property name)
-    return f"{int(connection_id):08x}"
+def _changed(nb_changes: int = 1) -> None:
+    """Persist changes, with the next background commit if it runs."""
+    global _commit_event, _pending_changes
+    if _commit_event is None:
+        _sync_db()
+        return
+    _pending_changes += nb_changes
+    _commit_event.set()
 
 
-def _get_user_name(user_id):
-    """Get the user name associated with the given user ID."""
-    user_id_int = int(user_id, 16)
-    resp = requests.get(
-        "http://{}:{}/api/login/user_name/{}".format(
-            _login_server["addr"], _login_server["port"], user_id_int
-        )
+def _ladder_key(user_id: str, user_info: dict) -> tuple[int, str, str]:
+    """Get the position of a named user in the ladder index."""
+    return (user_info["ranked_mmr"], user_info["name"], user_id)
+
+
+def _index_ladder() -> None:
+    """Rebuild the ladder index."""
+    global _ladder, _ladder_version, _unnamed_users, ranking_db
+    users = ranking_db["users"]
+    _ladder_version += 1
+    _ladder = Ladder(
+        _ladder_key(user_id, user_info)
+        for user_id, user_info in users.items()
+        if user_info["name"] is not None
     )
-    if resp.status_code != 200:
-        logging.error("bad status code for resoultion of user %s: %d", user_id, resp.status_code)
-        return None
-    user_name = json.loads(resp.text)
+    _unnamed_users = {
+        user_id for user_id, user_info in users.items() if user_info["name"] is None
+    }
+
+
+def _set_mmr(user_id: str, mmr_key: str, mmr: int) -> None:
+    """Change the MMR of a user, keeping the ladder index up to date."""
+    global _ladder, _ladder_version, ranking_db
+    user_info = ranking_db["users"][user_id]
+    if mmr_key == "ranked_mmr" and user_info["name"] is not None:
+        _ladder_version += 1
+        user_info[mmr_key] = mmr
+        _ladder.set_score(user_id, user_info["name"], mmr)
+    else:
+        user_info[mmr_key] = mmr
+
+
+def _set_name(user_id: str, name: str | None) -> None:
+    """Set the name of an unnamed user, adding it to the ladder index."""
+    global _ladder, _ladder_version, _unnamed_users, ranking_db
+    user_info = ranking_db["users"][user_id]
+    assert user_info["name"] is None
+    user_info["name"] = name
+    if name is not None:
+        _ladder_version += 1
+        _unnamed_users.discard(user_id)
+        _ladder.set_score(user_id, name, user_info["ranked_mmr"])
+
+        for season_id, season_ladder in _season_ladders.items():
+            season_mmrs = ranking_db["seasons"][season_id].get(user_id)
+            if season_mmrs is not None:
+                season_ladder.set_score(user_id, name, season_mmrs["ranked_mmr"])
+        for window, window_ladder in _window_ladders.items():
+            total = _window_totals[window].get(user_id)
+            if total is not None:
+                window_ladder.set_score(user_id, name, total[0])
+
+
+def _game_sides(
+    game_info: dict, user_a: str, user_b: str
+) -> tuple[str, str, str, str]:
+    """Get winner's user ID and MMR key, then loser's ones."""
+    mmr_key_a = "ranked_mmr" if game_info["player_a_ranked"] == 1 else "unranked_mmr"
+    mmr_key_b = "ranked_mmr" if game_info["player_b_ranked"] == 1 else "unranked_mmr"
+    if game_info["winner"] == 0:
+        return (user_a, mmr_key_a, user_b, mmr_key_b)
+    return (user_b, mmr_key_b, user_a, mmr_key_a)
+
+
+def _today() -> int:
+    """Get the current day, as a proleptic Gregorian ordinal."""
+    return datetime.datetime.now(datetime.timezone.utc).date().toordinal()
+
+
+def _day_of(timestamp: int) -> int:
+    """Get the day of a date in seconds since epoch, as an ordinal."""
+    return datetime.datetime.fromtimestamp(
+        timestamp, datetime.timezone.utc
+    ).date().toordinal()
+
+
+def _apply_season_game(
+    season_id: str, winner: str, winner_mmr_key: str, loser: str, loser_mmr_key: str
+) -> None:
+    """Apply a game to the MMRs of a season."""
+    global _season_ladders, ranking_db
+    season = ranking_db["seasons"].setdefault(season_id, {})
+    for user_id in [winner, loser]:
+        if user_id not in season:
+            season[user_id] = {"ranked_mmr": INITIAL_MMR, "unranked_mmr": INITIAL_MMR}
+
+    winner_mmr = season[winner][winner_mmr_key]
+    loser_mmr = season[loser][loser_mmr_key]
+    season[winner][winner_mmr_key] = _elo(winner_mmr, loser_mmr, 1)
+    season[loser][loser_mmr_key] = _elo(loser_mmr, winner_mmr, 0)
+
+    season_ladder = _season_ladders.setdefault(season_id, Ladder())
+    for user_id in [winner, loser]:
+        name = ranking_db["users"][user_id]["name"]
+        if name is not None:
+            season_ladder.set_score(user_id, name, season[user_id]["ranked_mmr"])
+
+
+def _add_window_delta(
+    totals: dict[str, list[int]], ladder: Ladder, user_id: str, delta: list[int]
+) -> None:
+    """Add (or subtract, with negative values) a daily delta to a window."""
+    global ranking_db
+    total = totals.setdefault(user_id, [0, 0])
+    total[0] += delta[0]
+    total[1] += delta[1]
+    name = ranking_db["users"][user_id]["name"]
+    if total[1] == 0:
+        del totals[user_id]
+        ladder.remove(user_id)
+    elif name is not None:
+        ladder.set_score(user_id, name, total[0])
+
+
+def _add_daily_delta(day: int, user_id: str, mmr_change: int) -> None:
+    """Record a ranked MMR change of a user, in a game of the given day."""
+    global _window_first_day, _window_ladders, _window_totals, ranking_db
+    if day < _today() - max(ROLLING_WINDOWS, default=0) + 1:
+        return
+    daily_deltas = ranking_db["daily_deltas"].setdefault(
+        datetime.date.fromordinal(day).isoformat(), {}
+    )
+    daily_delta = daily_deltas.setdefault(user_id, [0, 0])
+    daily_delta[0] += mmr_change
+    daily_delta[1] += 1
+    for window in ROLLING_WINDOWS:
+        if day >= _window_first_day[window]:
+            _add_window_delta(
+                _window_totals[window],
+                _window_ladders[window],
+                user_id,
+                [mmr_change, 1],
+            )
+
+
+def _add_window_days(window: int, days: Iterable[str], sign: int) -> None:
+    """Add (``sign`` 1) or subtract (``sign`` -1) the given days to a window."""
+    global _window_ladders, _window_totals, ranking_db
+    daily_deltas = ranking_db["daily_deltas"]
+    for day_iso in days:
+        for user_id, delta in daily_deltas.get(day_iso, {}).items():
+            _add_window_delta(
+                _window_totals[window],
+                _window_ladders[window],
+                user_id,
+                [sign * delta[0], sign * delta[1]],
+            )
+
 
-    if user_name is None:
+def _refresh_windows() -> None:
+    """Remove days which left rolling windows, forget days out of all windows."""
+    global _window_first_day, _window_ladders, _window_totals, ranking_db
+    today = _today()
+    daily_deltas = ranking_db["daily_deltas"]
+    for window in ROLLING_WINDOWS:
+        first_day = today - window + 1
+        previous_first_day = _window_first_day.get(window)
+        if previous_first_day is None:
+            # New window, sum the days it covers
+            _window_first_day[window] = first_day
+            _window_totals[window] = {}
+            _window_ladders[window] = Ladder()
+            _add_window_days(
+                window,
+                [
+                    day_iso
+                    for day_iso in daily_deltas
+                    if datetime.date.fromisoformat(day_iso).toordinal() >= first_day
+                ],
+                1,
+            )
+        elif previous_first_day < first_day:
+            _window_first_day[window] = first_day
+            _add_window_days(
+                window,
+                [
+                    datetime.date.fromordinal(day).isoformat()
+                    for day in range(previous_first_day, first_day)
+                ],
+                -1,
+            )
+
+    oldest_day = today - max(ROLLING_WINDOWS, default=0) + 1
+    for day_iso in list(daily_deltas):
+        if datetime.date.fromisoformat(day_iso).toordinal() < oldest_day:
+            del daily_deltas[day_iso]
+
+
+def _index_time_ladders() -> None:
+    """Rebuild seasons' and rolling windows' ladders."""
+    global _season_ladders, _window_first_day, _window_ladders, _window_totals
+    global ranking_db
+    users = ranking_db["users"]
+    _season_ladders = {}
+    for season_id, season in ranking_db["seasons"].items():
+        season_ladder = _season_ladders[season_id] = Ladder()
+        for user_id, season_mmrs in season.items():
+            if users[user_id]["name"] is not None:
+                season_ladder.set_score(
+                    user_id, users[user_id]["name"], season_mmrs["ranked_mmr"]
+                )
+
+    _window_first_day = {}
+    _window_ladders = {}
+    _window_totals = {}
+    _refresh_windows()
+
+
+def _game_key(game_info: dict) -> bytes | None:
+    """Get the deduplication key of a game, None if it has no valid UUID."""
+    try:
+        return uuid.UUID(str(game_info.get("game"))).bytes
+    except ValueError:
         return None
-    if not isinstance(user_name, str):
-        raise Exception(f"bad response type: {user_name}")
-    if len(user_name) < 3 or len(user_name) > 16:
-        raise Exception(f'unvalid name: "{user_name}"')
-    return user_name
+
+
+def _expire_pushed_games(now: int) -> None:
+    """Forget games pushed more than ``_dedup_window`` seconds ago."""
+    global _dedup_window, _pushed_games
+    horizon = now - _dedup_window
+    # Push order is time order, expired games are at the beginning
+    expired = []
+    for game_key, push_time in _pushed_games.items():
+        if push_time >= horizon:
+            break
+        expired.append(game_key)
+    for game_key in expired:
+        del _pushed_games[game_key]
+
+
+def _get_user_id(connection_id):
+    """Get the user ID associated with the given connection ID.
+
+    The login server gives their user ID to clients as connection ID, the
+    association does not depend on time.
+    """
+    # Convert it to hex string type (to be a valid json property name)
+    return f"{int(connection_id):08x}"
+
+
+def _get_users_ids(games_info: list[dict]) -> list[tuple[str, str]]:
+    """Get the user IDs of both players of each game."""
+    return [
+        (
+            _get_user_id(game_info["client_a"]),
+            _get_user_id(game_info["client_b"]),
+        )
+        for game_info in games_info
+    ]
+
+
+def _http_session() -> requests.Session:
+    """Get the HTTP session used to query the login server.
+
+    The session keeps connections alive between requests.
+    """
+    global _http
+    if _http is None:
+        _http = requests.Session()
+    return _http
+
+
+def _login_server_url(path: str) -> str:
+    """Get the URL of a login server's API."""
+    global _login_server
+    return "http://{}:{}{}".format(_login_server["addr"], _login_server["port"], path)
+
+
+def _fetch_user_names(user_ids: list[str]) -> dict[str, str]:
+    """Get the names of the given user IDs from the login server.
+
+    Unknown user IDs are omitted. Blocks on network, to be run in an executor.
+    """
+    user_names = {}
+    for chunk_begin in range(0, len(user_ids), NAME_BATCH_SIZE):
+        chunk = user_ids[chunk_begin : chunk_begin + NAME_BATCH_SIZE]
+        resp = _http_session().post(
+            _login_server_url("/api/login/user_names"),
+            json=[int(user_id, 16) for user_id in chunk],
+            timeout=LOGIN_SERVER_TIMEOUT,
+        )
+        if resp.status_code != 200:
+            raise Exception(
+                f"bad status code for resolution of users: {resp.status_code}"
+            )
+
+        for user_id_int, user_name in resp.json().items():
+            user_id = f"{int(user_id_int):08x}"
+            if not isinstance(user_name, str):
+                logging.error("bad user name type for user %s: %s", user_id, user_name)
+            elif len(user_name) < 3 or len(user_name) > 16:
+                logging.error('invalid name for user %s: "%s"', user_id, user_name)
+            else:
+                user_names[user_id] = user_name
+    return user_names
 
 
 #
@@ -98,112 +529,494 @@ def _get_user_name(user_id):
 #
 
 
-def load(db_file: str | Path | None, login_server: dict | None = None) -> None:
-    """Load the database from the given file."""
-    global _db_file, _login_server, ranking_db
+def load(
+    db_file: str | Path | None,
+    login_server: dict | None = None,
+    commit_delay: float = COMMIT_DELAY,
+    commit_batch_size: int = COMMIT_BATCH_SIZE,
+    dedup_window: int = DEDUP_WINDOW,
+) -> None:
+    """Load the database from the given file.
+
+    A ``commit_delay`` of zero writes the file on each change. Games journaled
+    after the last write of the file are replayed. Games pushed during the last
+    ``dedup_window`` seconds are read back from the games journal.
+    """
+    global _commit_batch_size, _commit_delay, _db_file, _dedup_window
+    global _games_journal, _login_server, _pending_changes, _pushed_games
+    global ranking_db
     if isinstance(db_file, str):
         db_file = Path(db_file)
     _db_file = db_file
+    _commit_delay = commit_delay
+    _commit_batch_size = commit_batch_size
+    _dedup_window = dedup_window
+    _pending_changes = 0
     if db_file is not None and db_file.is_file():
         with db_file.open() as f:
             ranking_db = json.load(f)
+    ranking_db.setdefault("seasons", {})
+    ranking_db.setdefault("daily_deltas", {})
+    # Pushed games used to be stored in the database
+    ranking_db.pop("pushed_games", None)
+    _index_ladder()
+    _index_time_ladders()
+
+    if _games_journal is not None:
+        _games_journal.close()
+        _games_journal = None
+    _pushed_games = {}
+    if db_file is not None:
+        _games_journal = gamejournal.GameJournal(_games_journal_path(db_file))
+        _replay_journal(db_file.is_file())
+        since = int(time.time()) - _dedup_window
+        _pushed_games.update(gamejournal.read_recent_games(_games_journal.path, since))
 
     _login_server = copy.deepcopy(login_server)
+    _unknown_users.clear()
+
+
+def _check_game(game_info: dict) -> None:
+    """Check that a game can be journaled and applied, raise if not."""
+    mandatory_fields = [
+        "begin",
+        "end",
+        "client_a",
+        "client_b",
+        "player_a_ranked",
+        "player_b_ranked",
+        "winner",
+    ]
+    for field in mandatory_fields:
+        if field not in game_info:
+            raise Exception(f'invalid game info format, missing "{field}" field')
+
+    for field in ["client_a", "client_b"]:
+        try:
+            client_id = int(game_info[field])
+        except (TypeError, ValueError):
+            client_id = -1
+        if not 0 <= client_id <= gamejournal.MAX_FIELD_VALUE:
+            raise Exception(f'invalid game info format, bad "{field}" field')
+
+    # Invalid dates are unknown, but valid ones must fit in the journal
+    for field in ["begin", "end"]:
+        if not 0 <= gamejournal.parse_date(game_info[field]) <= (
+            gamejournal.MAX_FIELD_VALUE
+        ):
+            raise Exception(f'invalid game info format, bad "{field}" field')
+
+
+def _new_games(games_info: list[dict]) -> tuple[list[dict], dict[bytes, int]]:
+    """Check pushed games, and filter out the ones already pushed.
+
+    Returns the games to apply, and their deduplication keys with push time.
+    """
+    global _pushed_games
 
+    # Check games consistency, before any change
+    for game_info in games_info:
+        _check_game(game_info)
 
-def push_games(games_info: list[dict]) -> None:
-    """Push the given games info to the database."""
-    global ranking_db
-
-    # Update rankings
+    # Ignore games already pushed
+    now = int(time.time())
+    _expire_pushed_games(now)
+    new_games_info = []
+    new_game_keys = {}
     for game_info in games_info:
-        # Check game consistency
-        mandatory_fields = [
-            "begin",
-            "end",
-            "client_a",
-            "client_b",
-            "player_a_ranked",
-            "player_b_ranked",
-            "winner",
-        ]
-        for field in mandatory_fields:
-            if field not in game_info:
-                raise Exception(
-                    f'invalid game info format, missing "{field}" field'
-                )
+        game_key = _game_key(game_info)
+        if game_key is not None:
+            if game_key in _pushed_games or game_key in new_game_keys:
+                logging.info("ignored already pushed game %s", game_key.hex())
+                continue
+            new_game_keys[game_key] = now
+        new_games_info.append(game_info)
+    return (new_games_info, new_game_keys)
+
+
+def _apply_games(
+    games_info: list[dict],
+    games_users: list[tuple[str, str]],
+    game_keys: dict[bytes, int],
+) -> int:
+    """Apply new games, played by the given (user A, user B) IDs."""
+    global _games_journal, _pushed_games
+    _refresh_windows()
+
+    # Record games, so that rankings can be recomputed
+    if _games_journal is not None:
+        _games_journal.append(
+            [
+                gamejournal.encode_game(game_info, int(user_a, 16), int(user_b, 16))
+                for game_info, (user_a, user_b) in zip(games_info, games_users)
+            ]
+        )
+
+    _update_rankings(games_info, games_users)
 
-        # Retrieve users IDs
-        user_a = _get_user_id(game_info["begin"], game_info["client_a"])
-        user_b = _get_user_id(game_info["begin"], game_info["client_b"])
+    # Games are applied, remember them
+    _pushed_games.update(game_keys)
 
+    # Update DB file
+    _changed(len(games_info))
+    return len(games_info)
+
+
+def _update_rankings(
+    games_info: list[dict], games_users: list[tuple[str, str]]
+) -> None:
+    """Update MMRs and ladders with games played by the given user IDs."""
+    global _unnamed_users, ranking_db
+    for game_info, (user_a, user_b) in zip(games_info, games_users):
         # Create missing users
         for user_id in [user_a, user_b]:
             if user_id not in ranking_db["users"]:
                 ranking_db["users"][user_id] = {
-                    "ranked_mmr": 1000,
-                    "unranked_mmr": 1000,
+                    "ranked_mmr": INITIAL_MMR,
+                    "unranked_mmr": INITIAL_MMR,
                     "name": None,
                 }
+                _unnamed_users.add(user_id)
 
         # Apply MMR change
-        if game_info["winner"] == 0:
-            winner = user_a
-            loser = user_b
-            winner_mmr_key = (
-                "ranked_mmr" if game_info["player_a_ranked"] == 1 else "unranked_mmr"
-            )
-            loser_mmr_key = (
-                "ranked_mmr" if game_info["player_b_ranked"] == 1 else "unranked_mmr"
+        winner, winner_mmr_key, loser, loser_mmr_key = _game_sides(
+            game_info, user_a, user_b
+        )
+        winner_mmr = ranking_db["users"][winner][winner_mmr_key]
+        loser_mmr = ranking_db["users"][loser][loser_mmr_key]
+
+        _set_mmr(winner, winner_mmr_key, _elo(winner_mmr, loser_mmr, 1))
+        _set_mmr(loser, loser_mmr_key, _elo(loser_mmr, winner_mmr, 0))
+
+        # Update time-windowed ladders
+        begin = gamejournal.parse_date(game_info["begin"])
+        if begin != 0:
+            _apply_season_game(
+                get_season_id(begin), winner, winner_mmr_key, loser, loser_mmr_key
             )
+            for user_id, mmr_key, previous_mmr in [
+                (winner, winner_mmr_key, winner_mmr),
+                (loser, loser_mmr_key, loser_mmr),
+            ]:
+                if mmr_key == "ranked_mmr":
+                    _add_daily_delta(
+                        _day_of(begin),
+                        user_id,
+                        ranking_db["users"][user_id][mmr_key] - previous_mmr,
+                    )
+
+
+def _replay_journal(db_file_exists: bool) -> None:
+    """Apply the games journaled after the last write of the database file."""
+    global _games_journal, ranking_db
+    nb_records = _games_journal.nb_records
+    if db_file_exists:
+        # Databases written before the number was stored include all games
+        first_record = ranking_db.get("journaled_games", nb_records)
+    else:
+        first_record = 0
+    if first_record > nb_records:
+        logging.warning(
+            "games journal shorter than the database, %d games are missing",
+            first_record - nb_records,
+        )
+        first_record = nb_records
+
+    nb_games = 0
+    for chunk in gamejournal.read_chunks(
+        _games_journal.path, first_record=first_record
+    ):
+        games = [
+            gamejournal.decode_game(chunk[offset : offset + gamejournal.RECORD.size])
+            for offset in range(0, len(chunk), gamejournal.RECORD.size)
+        ]
+        _update_rankings(
+            [game_info for game_info, _, _ in games],
+            [(f"{user_a:08x}", f"{user_b:08x}") for _, user_a, user_b in games],
+        )
+        nb_games += len(games)
+
+    ranking_db["journaled_games"] = nb_records
+    if nb_games > 0:
+        logging.info("replayed %d games from the games journal", nb_games)
+        _sync_db()
+
+
+def push_games(games_info: list[dict]) -> int:
+    """Push the given games info to the database.
+
+    Returns the number of games applied, games already pushed are ignored.
+    Concurrent writers must go through ``push`` instead.
+    """
+    games_info, game_keys = _new_games(games_info)
+    if not games_info:
+        return 0
+    return _apply_games(games_info, _get_users_ids(games_info), game_keys)
+
+
+async def _submit(operation, *args):
+    """Have the writer call ``operation(*args)``, and get its result.
+
+    Without writer running, the operation is called directly.
+    """
+    global _write_queue
+    if _write_queue is None:
+        return operation(*args)
+
+    future = asyncio.get_running_loop().create_future()
+    await _write_queue.put((operation, args, future))
+    return await future
+
+
+def get_ladder(offset: int = 0, limit: int | None = None) -> list[dict]:
+    """Get the current ladder, or the page of ``limit`` players from ``offset``."""
+    global _ladder
+    return [
+        {"mmr": mmr, "user_name": user_name}
+        for mmr, user_name in _ladder.page(offset, limit)
+    ]
+
+
+def get_seasons() -> list[str]:
+    """Get the IDs of seasons with games, in chronological order."""
+    global _season_ladders
+    return sorted(_season_ladders)
+
+
+def get_season_id(timestamp: int) -> str:
+    """Get the ID of the season containing a date, in seconds since epoch."""
+    date = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    return f"{date.year}-S{(date.month - 1) // SEASON_MONTHS + 1}"
+
+
+def get_current_season() -> str:
+    """Get the ID of the season in progress."""
+    return get_season_id(int(time.time()))
+
+
+def get_season_ladder(
+    season_id: str, offset: int = 0, limit: int | None = None
+) -> list[dict] | None:
+    """Get the ladder of a season, or a page of it, None if no such season."""
+    global _season_ladders
+    season_ladder = _season_ladders.get(season_id)
+    if season_ladder is None:
+        return None
+    return [
+        {"mmr": mmr, "user_name": user_name}
+        for mmr, user_name in season_ladder.page(offset, limit)
+    ]
+
+
+def get_window_ladder(
+    window: int, offset: int = 0, limit: int | None = None
+) -> list[dict] | None:
+    """Get the ladder of a rolling window, or a page of it, None if no such window.
+
+    Players are ranked by ranked MMR won during the last ``window`` days.
+    """
+    global _window_ladders
+    window_ladder = _window_ladders.get(window)
+    if window_ladder is None:
+        return None
+    return [
+        {"mmr_change": mmr_change, "user_name": user_name}
+        for mmr_change, user_name in window_ladder.page(offset, limit)
+    ]
+
+
+def get_ladder_version() -> int:
+    """Get a number which changes each time the ladder changes."""
+    global _ladder_version
+    return _ladder_version
+
+
+def get_rank(user_id: str) -> int | None:
+    """Get the rank of a user in the ladder, 1 for the best, None if not in it."""
+    global _ladder
+    ranking = _ladder.get(user_id)
+    return None if ranking is None else ranking[0]
+
+
+def get_user_ranking(user_id: str, nb_neighbours: int = 0) -> dict | None:
+    """Get the ranking of a user, and of the players around, None if not ranked.
+
+    Neighbours are the players ranked up to ``nb_neighbours`` above or below
+    the user, the user included.
+    """
+    global _ladder
+    ranking = _ladder.get(user_id)
+    if ranking is None:
+        return None
+
+    rank, mmr, user_name = ranking
+    first_rank = max(1, rank - nb_neighbours)
+    neighbours = _ladder.page(first_rank - 1, rank + nb_neighbours - first_rank + 1)
+    return {
+        "user_name": user_name,
+        "mmr": mmr,
+        "rank": rank,
+        "neighbours": [
+            {"rank": first_rank + index, "mmr": neighbour_mmr, "user_name": name}
+            for index, (neighbour_mmr, name) in enumerate(neighbours)
+        ],
+    }
+
+
+def get_unnamed_users() -> list[str]:
+    """Get the IDs of users whose name should be asked to the login server."""
+    global _unknown_users, _unnamed_users
+    now = time.monotonic()
+    return [
+        user_id
+        for user_id in _unnamed_users
+        if _unknown_users.get(user_id, 0) <= now
+    ]
+
+
+def set_user_names(user_ids: list[str], user_names: dict[str, str]) -> None:
+    """Apply the result of a name resolution.
+
+    ``user_ids`` were asked to the login server, ``user_names`` is its answer.
+    """
+    global _unknown_users, _unnamed_users, ranking_db
+    retry_time = time.monotonic() + UNKNOWN_NAME_TTL
+    for user_id in user_ids:
+        if user_id not in _unnamed_users:
+            continue
+        user_name = user_names.get(user_id)
+        if user_name is None:
+            _unknown_users[user_id] = retry_time
         else:
-            winner = user_b
-            loser = user_a
-            winner_mmr_key = (
-                "ranked_mmr" if game_info["player_b_ranked"] == 1 else "unranked_mmr"
-            )
-            loser_mmr_key = (
-                "ranked_mmr" if game_info["player_a_ranked"] == 1 else "unranked_mmr"
-            )
+            _unknown_users.pop(user_id, None)
+            _set_name(user_id, user_name)
 
-        winner = ranking_db["users"][winner]
-        loser = ranking_db["users"][loser]
-        winner_mmr = winner[winner_mmr_key]
-        loser_mmr = loser[loser_mmr_key]
+    if user_names:
+        _changed(len(user_names))
 
-        winner[winner_mmr_key] = _elo(winner_mmr, loser_mmr, 1)
-        loser[loser_mmr_key] = _elo(loser_mmr, winner_mmr, 0)
 
-    # Update DB file
-    _sync_db()
+async def push(games_info: list[dict]) -> int:
+    """Push the given games info to the database, through the writer.
 
+    Returns the number of games applied, games already pushed are ignored.
+    """
+    return await _submit(push_games, games_info)
 
-def get_ladder() -> list[dict]:
-    """Get the current ladder."""
-    global ranking_db
-    users = ranking_db["users"]
 
-    # Update names of ranked players
-    db_updated = False
+async def run_writer(refresh_interval: float = WINDOWS_REFRESH_INTERVAL) -> None:
+    """Apply queued changes one at a time, forever.
+
+    Rolling windows are also refreshed, at least every ``refresh_interval``
+    seconds.
+    """
+    global _write_queue
+    _write_queue = asyncio.Queue()
     try:
-        for user_id in users:
-            user_info = users[user_id]
-            if user_info["name"] is None:
-                user_info["name"] = _get_user_name(user_id)
-                db_updated = True
-    except Exception:
-        logging.exception("Failed to retrieve new ranked players names")
-
-    if db_updated:
-        _sync_db()
+        while True:
+            try:
+                operation, args, future = await asyncio.wait_for(
+                    _write_queue.get(), refresh_interval
+                )
+            except asyncio.TimeoutError:
+                _refresh_windows()
+                continue
+            if future.cancelled():
+                continue
+
+            _refresh_windows()
+            try:
+                result = operation(*args)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+    finally:
+        write_queue = _write_queue
+        _write_queue = None
+        while not write_queue.empty():
+            write_queue.get_nowait()[2].cancel()
+
+
+async def resolve_names(interval: float = NAME_RESOLUTION_INTERVAL) -> None:
+    """Resolve names of new users, every ``interval`` seconds, forever.
+
+    Requests to the login server are sent from the default executor, names
+    are applied by the writer.
+    """
+    global _login_server
+    loop = asyncio.get_running_loop()
+    while True:
+        user_ids = get_unnamed_users() if _login_server is not None else []
+        if user_ids:
+            try:
+                user_names = await loop.run_in_executor(
+                    None, _fetch_user_names, user_ids
+                )
+            except Exception:
+                logging.exception("Failed to retrieve new ranked players names")
+            else:
+                await _submit(set_user_names, user_ids, user_names)
+        await asyncio.sleep(interval)
 
-    # Generate sorted array of player
-    return sorted(
-        [
-            {"mmr": users[u]["ranked_mmr"], "user_name": users[u]["name"]}
-            for u in users
-            if users[u]["name"] is not None
-        ],
-        key=lambda x: (x["mmr"], x["user_name"]),
-        reverse=True,
-    )
+
+async def flush() -> None:
+    """Write pending changes to the database file.
+
+    The database is serialized on the event loop, then written from the default
+    executor.
+    """
+    global _commit_lock, _db_file, _pending_changes, ranking_db
+    if _commit_lock is None:
+        _commit_lock = asyncio.Lock()
+    async with _commit_lock:
+        if _pending_changes == 0 or _db_file is None:
+            return
+        nb_changes = _pending_changes
+        serialized_db = _serialize_db()
+        _pending_changes = 0
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, _write_db, _db_file, serialized_db
+            )
+        except Exception:
+            # Keep the changes pending, to be written by the next commit
+            _pending_changes += nb_changes
+            raise
+
+
+async def commit_changes() -> None:
+    """Write changes to the database file by groups, forever.
+
+    Without commit delay, changes are written as soon as possible.
+    """
+    global _commit_batch_size, _commit_delay, _commit_event, _pending_changes
+    loop = asyncio.get_running_loop()
+    _commit_event = asyncio.Event()
+    if _pending_changes > 0:
+        _commit_event.set()
+    try:
+        while True:
+            # Wait for a first change, then for the delay or a full batch
+            await _commit_event.wait()
+            deadline = loop.time() + _commit_delay
+            while _pending_changes < _commit_batch_size:
+                _commit_event.clear()
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(_commit_event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            _commit_event.clear()
+
+            try:
+                await flush()
+            except Exception:
+                logging.exception("Failed to write the ranking database")
+                await asyncio.sleep(max(_commit_delay, COMMIT_RETRY_DELAY))
+                _commit_event.set()
+    finally:
+        _commit_event = None
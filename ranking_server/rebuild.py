@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+"""Offline rebuild of the ranking database from its games journal.
+
+Replays every game of the journal, from the initial MMR of all players, and
+writes the resulting ranking database. Names of players are copied from an
+existing ranking database. Seasons' MMRs, and the daily ranked MMR changes of
+the rolling windows, are recomputed from the games' begin dates.
+
+The journal is read by chunks. When NumPy is installed, chunks are decoded in
+bulk and player IDs mapped to dense indices per chunk; otherwise records are
+unpacked one by one. MMRs are then updated game by game, from flat arrays
+indexed by player, with Elo changes cached by MMR difference.
+"""
+
+from __future__ import annotations
+
+import datetime
+import json
+import sys
+import time
+from pathlib import Path
+
+import click
+
+from . import gamejournal
+from .rankingdb import ROLLING_WINDOWS, elo_delta, get_season_id
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Parameters' default
+INITIAL_MMR = 1000
+
+SECONDS_PER_DAY = 24 * 3600
+
+#
+# Journal decoding
+#
+
+
+def _decode_chunk(
+    chunk: bytes, player_indexes: dict[int, int]
+) -> tuple[list[int], list[int], list[int], list[int]]:
+    """Get players' indexes, flags and begin dates of the games of a chunk."""
+    players_a = []
+    players_b = []
+    flags = []
+    begins = []
+    for _, begin, _, user_a, user_b, game_flags in gamejournal.RECORD.iter_unpack(
+        chunk
+    ):
+        players_a.append(player_indexes.setdefault(user_a, len(player_indexes)))
+        players_b.append(player_indexes.setdefault(user_b, len(player_indexes)))
+        flags.append(game_flags)
+        begins.append(begin)
+    return (players_a, players_b, flags, begins)
+
+
+def _decode_chunk_numpy(
+    chunk: bytes, player_indexes: dict[int, int]
+) -> tuple[list[int], list[int], list[int], list[int]]:
+    """Get players' indexes, flags and begin dates of a chunk, using NumPy."""
+    records = np.frombuffer(chunk, dtype=_RECORD_DTYPE)
+    user_ids = np.concatenate((records["user_a"], records["user_b"]))
+    unique_user_ids, inverse = np.unique(user_ids, return_inverse=True)
+    unique_indexes = np.array(
+        [
+            player_indexes.setdefault(user_id, len(player_indexes))
+            for user_id in unique_user_ids.tolist()
+        ],
+        dtype=np.int64,
+    )
+    players = unique_indexes[inverse.reshape(-1)]
+    return (
+        players[: len(records)].tolist(),
+        players[len(records) :].tolist(),
+        records["flags"].tolist(),
+        records["begin"].tolist(),
+    )
+
+
+if np is not None:
+    _RECORD_DTYPE = np.dtype(
+        [
+            ("game", "V16"),
+            ("begin", "<u4"),
+            ("end", "<u4"),
+            ("user_a", "<u4"),
+            ("user_b", "<u4"),
+            ("flags", "u1"),
+        ]
+    )
+    assert _RECORD_DTYPE.itemsize == gamejournal.RECORD.size
+
+#
+# Replay
+#
+
+
+def _replay_games(
+    mmrs: list[int],
+    players_a: list[int],
+    players_b: list[int],
+    flags: list[int],
+    days: list[int],
+    first_day: int = sys.maxsize,
+    daily_deltas: dict[int, dict[int, list[int]]] | None = None,
+) -> None:
+    """Apply games to MMRs.
+
+    ``mmrs[2 * player]`` is the ranked MMR of a player, ``mmrs[2 * player + 1]``
+    its unranked MMR.
+
+    Ranked MMR changes of games played from ``first_day`` are summed in
+    ``daily_deltas``, by day then player, with the number of games.
+    """
+    win_deltas: dict[int, float] = {}
+    loss_deltas: dict[int, float] = {}
+    a_ranked = gamejournal.FLAG_A_RANKED
+    b_ranked = gamejournal.FLAG_B_RANKED
+    b_wins = gamejournal.FLAG_B_WINS
+    for player_a, player_b, game_flags, day in zip(players_a, players_b, flags, days):
+        slot_a = 2 * player_a + (0 if game_flags & a_ranked else 1)
+        slot_b = 2 * player_b + (0 if game_flags & b_ranked else 1)
+        if game_flags & b_wins:
+            winner_slot, loser_slot = slot_b, slot_a
+        else:
+            winner_slot, loser_slot = slot_a, slot_b
+
+        winner_mmr = mmrs[winner_slot]
+        loser_mmr = mmrs[loser_slot]
+        difference = loser_mmr - winner_mmr
+        win_delta = win_deltas.get(difference)
+        if win_delta is None:
+            win_delta = win_deltas[difference] = elo_delta(difference, 1)
+        loss_delta = loss_deltas.get(-difference)
+        if loss_delta is None:
+            loss_delta = loss_deltas[-difference] = elo_delta(-difference, 0)
+
+        mmrs[winner_slot] = max(0, round(winner_mmr + win_delta))
+        mmrs[loser_slot] = max(0, round(loser_mmr + loss_delta))
+
+        if day >= first_day and daily_deltas is not None:
+            deltas = daily_deltas.setdefault(day, {})
+            for slot, previous_mmr in [
+                (winner_slot, winner_mmr),
+                (loser_slot, loser_mmr),
+            ]:
+                if slot % 2 == 0:
+                    delta = deltas.setdefault(slot // 2, [0, 0])
+                    delta[0] += mmrs[slot] - previous_mmr
+                    delta[1] += 1
+
+
+def _replay_seasons(
+    seasons_mmrs: dict[str, list[int]],
+    seasons_players: dict[str, set[int]],
+    nb_players: int,
+    players_a: list[int],
+    players_b: list[int],
+    flags: list[int],
+    days: list[int],
+    day_seasons: dict[int, str | None],
+) -> None:
+    """Apply games to the MMRs of their season, see ``_replay_games``."""
+    # Split games by season, most chunks are in only one season
+    seasons_games: dict[str, list[int]] = {}
+    for game_index, day in enumerate(days):
+        if day not in day_seasons:
+            day_seasons[day] = (
+                None if day < 0 else get_season_id(day * SECONDS_PER_DAY)
+            )
+        season_id = day_seasons[day]
+        if season_id is not None:
+            seasons_games.setdefault(season_id, []).append(game_index)
+
+    for season_id, games in seasons_games.items():
+        season_mmrs = seasons_mmrs.setdefault(season_id, [])
+        season_mmrs.extend([INITIAL_MMR] * (2 * nb_players - len(season_mmrs)))
+        season_players_a = [players_a[game_index] for game_index in games]
+        season_players_b = [players_b[game_index] for game_index in games]
+        _replay_games(
+            season_mmrs,
+            season_players_a,
+            season_players_b,
+            [flags[game_index] for game_index in games],
+            [days[game_index] for game_index in games],
+        )
+        season_players = seasons_players.setdefault(season_id, set())
+        season_players.update(season_players_a)
+        season_players.update(season_players_b)
+
+
+def _day_iso(day: int) -> str:
+    """Get the ISO 8601 date of a day since epoch."""
+    return (
+        datetime.datetime.fromtimestamp(day * SECONDS_PER_DAY, datetime.timezone.utc)
+        .date()
+        .isoformat()
+    )
+
+
+def rebuild(
+    journal_path: Path,
+    chunk_records: int = gamejournal.CHUNK_RECORDS,
+    use_numpy: bool = True,
+) -> tuple[dict, int]:
+    """Replay a games journal.
+
+    Returns the ranking database, without players' names, and the number of
+    games.
+    """
+    decode = _decode_chunk_numpy if use_numpy and np is not None else _decode_chunk
+    player_indexes: dict[int, int] = {}
+    mmrs: list[int] = []
+    seasons_mmrs: dict[str, list[int]] = {}
+    seasons_players: dict[str, set[int]] = {}
+    day_seasons: dict[int, str | None] = {}
+    daily_deltas: dict[int, dict[int, list[int]]] = {}
+    first_day = int(time.time()) // SECONDS_PER_DAY - max(ROLLING_WINDOWS) + 1
+    nb_games = 0
+    for chunk in gamejournal.read_chunks(journal_path, chunk_records):
+        players_a, players_b, flags, begins = decode(chunk, player_indexes)
+        # Games without begin date are in no season nor window
+        days = [begin // SECONDS_PER_DAY if begin != 0 else -1 for begin in begins]
+        mmrs.extend([INITIAL_MMR] * (2 * len(player_indexes) - len(mmrs)))
+        _replay_games(mmrs, players_a, players_b, flags, days, first_day, daily_deltas)
+        _replay_seasons(
+            seasons_mmrs,
+            seasons_players,
+            len(player_indexes),
+            players_a,
+            players_b,
+            flags,
+            days,
+            day_seasons,
+        )
+        nb_games += len(flags)
+
+    hex_user_ids = [f"{user_id:08x}" for user_id in player_indexes]
+    return (
+        {
+            "users": {
+                hex_user_ids[index]: {
+                    "ranked_mmr": mmrs[2 * index],
+                    "unranked_mmr": mmrs[2 * index + 1],
+                    "name": None,
+                }
+                for index in range(len(hex_user_ids))
+            },
+            "seasons": {
+                season_id: {
+                    hex_user_ids[index]: {
+                        "ranked_mmr": seasons_mmrs[season_id][2 * index],
+                        "unranked_mmr": seasons_mmrs[season_id][2 * index + 1],
+                    }
+                    for index in sorted(season_players)
+                }
+                for season_id, season_players in sorted(seasons_players.items())
+            },
+            "daily_deltas": {
+                _day_iso(day): {
+                    hex_user_ids[index]: delta for index, delta in deltas.items()
+                }
+                for day, deltas in sorted(daily_deltas.items())
+            },
+            "journaled_games": nb_games,
+        },
+        nb_games,
+    )
+
+
+@click.command()
+@click.argument("journal", type=Path)
+@click.argument("output", type=Path)
+@click.option(
+    "--names-db",
+    type=Path,
+    default=None,
+    help="ranking database from which players' names are copied",
+)
+@click.option(
+    "--chunk-records",
+    type=click.IntRange(min=1),
+    default=gamejournal.CHUNK_RECORDS,
+    help="number of games read at once from the journal",
+)
+@click.option(
+    "--numpy/--no-numpy",
+    default=True,
+    help="decode the journal with NumPy, if installed",
+)
+def main(
+    journal: Path,
+    output: Path,
+    names_db: Path | None,
+    chunk_records: int,
+    numpy: bool,
+):
+    """Rebuild a ranking database by replaying its games JOURNAL to OUTPUT."""
+    if numpy and np is None:
+        click.echo("NumPy is not installed, decoding without it", err=True)
+
+    begin = time.perf_counter()
+    ranking_db, nb_games = rebuild(journal, chunk_records, numpy)
+    duration = time.perf_counter() - begin
+
+    names = {}
+    if names_db is not None:
+        with names_db.open() as f:
+            names = {
+                user_id: user_info["name"]
+                for user_id, user_info in json.load(f)["users"].items()
+            }
+
+    for user_id, user_info in ranking_db["users"].items():
+        user_info["name"] = names.get(user_id)
+
+    tmp_output = Path(f"{output}.tmp")
+    with tmp_output.open("w") as f:
+        json.dump(ranking_db, f)
+    tmp_output.replace(output)
+
+    click.echo(
+        f"replayed {nb_games} games of {len(ranking_db['users'])} players"
+        f" in {duration:.2f}s ({nb_games / max(duration, 1e-9):.0f} games/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,55 @@
 
 from __future__ import annotations
 
-from fastapi import FastAPI, HTTPException, Request
+import asyncio
+import json
+import time
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 
 from . import rankingdb
 
+# Maximum number of players returned by one request
+LADDER_MAX_LIMIT = 1000
+MAX_NEIGHBOURS = 50
+
+# Maximum number of ladder pages kept encoded
+LADDER_CACHE_SIZE = 64
+
+#
+# Working structures
+#
+
+# Encoded ladder pages, by (offset, limit), for the ladder version in the ETag
+_ladder_cache: dict[tuple[int, Optional[int]], bytes] = {}
+_ladder_etag = ""
+
+# Distinguishes ETags of this process from the ones of previous runs
+_etag_prefix = f"{time.time_ns():x}"
+
 app = FastAPI()
 
 
+@app.on_event("startup")
+async def startup_event():
+    """Start applying, resolving names and writing changes in the background."""
+    app.state.background_tasks = [
+        asyncio.create_task(rankingdb.run_writer()),
+        asyncio.create_task(rankingdb.resolve_names()),
+        asyncio.create_task(rankingdb.commit_changes()),
+    ]
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background tasks, and write pending changes."""
+    for task in app.state.background_tasks:
+        task.cancel()
+    await asyncio.gather(*app.state.background_tasks, return_exceptions=True)
+    await rankingdb.flush()
+
+
 @app.middleware("http")
 async def check_addr(request: Request, call_next):
     """Check if the request is from a whitelisted address."""
@@ -19,22 +61,124 @@ async def check_addr(request: Request, call_next):
 
 @app.post("/api/rankings")
 async def post_rankings(msg: list[dict]) -> dict:
-    """Push a list of games to the ranking service."""
+    """Push a list of games to the ranking service.
+
+    Games already pushed are acknowledged but not applied again.
+    """
     try:
-        rankingdb.push_games(msg)
+        nb_applied = await rankingdb.push(msg)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
-    return {"status": "ok"}
+    return {"status": "ok", "applied": nb_applied, "duplicates": len(msg) - nb_applied}
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """Check if an If-None-Match header matches an ETag."""
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate in (etag, "*"):
+            return True
+    return False
 
 
 @app.get("/api/rankings")
-async def get_rankings():
-    """Get the current rankings."""
+async def get_rankings(
+    request: Request,
+    offset: int = Query(default=0, ge=0),
+    limit: Optional[int] = Query(default=None, ge=1, le=LADDER_MAX_LIMIT),
+) -> Response:
+    """Get the current rankings.
+
+    Without ``limit``, all players from ``offset`` are returned. Responses are
+    cached until the ladder changes, and tagged for conditional requests.
+    """
+    global _ladder_cache, _ladder_etag
+    etag = f'"{_etag_prefix}-{rankingdb.get_ladder_version()}"'
+    if etag != _ladder_etag:
+        _ladder_cache = {}
+        _ladder_etag = etag
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    content = _ladder_cache.get((offset, limit))
+    if content is None:
+        try:
+            ladder = rankingdb.get_ladder(offset, limit)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e)) from e
+        content = json.dumps(ladder, separators=(",", ":")).encode()
+        if len(_ladder_cache) >= LADDER_CACHE_SIZE:
+            _ladder_cache.clear()
+        _ladder_cache[(offset, limit)] = content
+
+    return Response(content, media_type="application/json", headers={"ETag": etag})
+
+
+@app.get("/api/rankings/user/{user_id}")
+async def get_user_ranking(
+    user_id: int,
+    neighbours: int = Query(default=2, ge=0, le=MAX_NEIGHBOURS),
+) -> dict:
+    """Get a player's MMR, rank and the players ranked around."""
     try:
-        return rankingdb.get_ladder()
+        user_ranking = rankingdb.get_user_ranking(f"{user_id:08x}", neighbours)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
 
+    if user_ranking is None:
+        raise HTTPException(status_code=404, detail="User not ranked")
+    return user_ranking
+
+
+@app.get("/api/rankings/seasons")
+async def get_seasons() -> dict:
+    """Get the seasons with games, and the season in progress."""
+    try:
+        return {
+            "seasons": rankingdb.get_seasons(),
+            "current": rankingdb.get_current_season(),
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+
+@app.get("/api/rankings/seasons/{season_id}")
+async def get_season_rankings(
+    season_id: str,
+    offset: int = Query(default=0, ge=0),
+    limit: Optional[int] = Query(default=None, ge=1, le=LADDER_MAX_LIMIT),
+) -> list[dict]:
+    """Get the rankings of a season."""
+    try:
+        ladder = rankingdb.get_season_ladder(season_id, offset, limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+    if ladder is None:
+        raise HTTPException(status_code=404, detail="Unknown season")
+    return ladder
+
+
+@app.get("/api/rankings/window/{days}")
+async def get_window_rankings(
+    days: int,
+    offset: int = Query(default=0, ge=0),
+    limit: Optional[int] = Query(default=None, ge=1, le=LADDER_MAX_LIMIT),
+) -> list[dict]:
+    """Get the rankings by ranked MMR won during the last ``days`` days."""
+    try:
+        ladder = rankingdb.get_window_ladder(days, offset, limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+    if ladder is None:
+        raise HTTPException(status_code=404, detail="Unknown window")
+    return ladder
+
 
 def serve(port, whitelist=None):
     """Serve the ranking service on the given port."""